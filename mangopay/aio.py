@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import asyncio
+import copy
+import time
+
+from .api import APIRequest, logger
+from .deadline import deadline_context, get_remaining
+from .signals import request_started, pre_save
+from .timing import RequestTiming
+from .tracing import trace
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+if aiohttp is not None:
+    connection_errors = (aiohttp.ClientConnectionError, asyncio.TimeoutError, OSError)
+else:
+    connection_errors = (asyncio.TimeoutError, OSError)
+
+
+class AsyncResponse(object):
+    """
+    Exposes the parts of a ``requests.Response`` that ``APIRequest``
+    relies on, built from a fully read aiohttp response.
+    """
+
+    def __init__(self, status_code, headers, content, url=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncAPIRequest(APIRequest):
+    """
+    An ``APIRequest`` running on an asyncio HTTP client (aiohttp).
+
+    ``request`` is a coroutine; everything else (authentication, payload
+    encoding, signals and error mapping) is shared with ``APIRequest``.
+    Pool options are mapped onto aiohttp's ``TCPConnector``, which always
+    waits for a free connection once the limits are reached.
+    """
+
+    def __init__(self, *args, session=None, **kwargs):
+        super(AsyncAPIRequest, self).__init__(*args, **kwargs)
+
+        self._session = session
+        self._tasks = {}
+
+    @property
+    def session(self):
+        if self._session is None:
+            if aiohttp is None:
+                raise ImportError('aiohttp is required to use AsyncAPIRequest '
+                                  '(pip install python-mangopay[async])')
+
+            connector = aiohttp.TCPConnector(limit=self.pool_connections * self.pool_maxsize,
+                                             limit_per_host=self.pool_maxsize,
+                                             keepalive_timeout=self.keep_alive_timeout or 15)
+
+            self._session = aiohttp.ClientSession(connector=connector)
+
+        return self._session
+
+    async def request(self, method, url, data=None, headers=None, endpoint=None, **params):
+        endpoint = endpoint or self._get_endpoint(url)
+
+        with trace(self.tracer, 'mangopay.request', {'http.method': method.upper(), 'http.route': endpoint}) as span:
+            timing = RequestTiming()
+            url, data, headers, truncated_data = self._prepare_request(method, url, data, headers, params, timing)
+
+            span.set_attribute('http.url', url)
+            span.set_attribute('http.request_content_length', self._get_size(data))
+
+            def send():
+                if self.hedge_policy is not None and method.upper() == 'GET':
+                    return self._send_hedged(method, url, data, headers, truncated_data, timing, endpoint)
+
+                return self._send(method, url, data, headers, truncated_data, timing, endpoint)
+
+            if self.in_flight is None or method.upper() != 'GET':
+                result, content = await send()
+            else:
+                key = self._get_flight_key(url, headers)
+                task = self._tasks.get(key)
+                shared = task is not None
+
+                if not shared:
+                    task = self._tasks[key] = asyncio.ensure_future(send())
+                    task.add_done_callback(lambda task: self._tasks.pop(key, None))
+
+                try:
+                    # a cancelled waiter must not cancel the call the others wait for
+                    result, content = await asyncio.wait_for(asyncio.shield(task), get_remaining())
+                except asyncio.TimeoutError:
+                    self._create_deadlineerror(url)
+
+                if shared:
+                    result, content = self._copy_result(result), copy.deepcopy(content)
+
+            self._finish_span(span, result)
+
+            return result, content
+
+    async def _send_hedged(self, method, url, data, headers, truncated_data, timing=None, endpoint=None):
+        async def send():
+            ts = time.time()
+            response = await self._send(method, url, data, headers, truncated_data, timing, endpoint)
+            self.hedge_policy.record(time.time() - ts)
+
+            return response
+
+        delay = self.hedge_policy.get_delay()
+
+        if delay is None or not self.hedge_policy.can_hedge():
+            return await send()
+
+        pending = [asyncio.ensure_future(send())]
+        done, not_done = await asyncio.wait(pending, timeout=delay)
+
+        if not done and self.hedge_policy.acquire():
+            logger.info('HEDGE[%s %s] no answer after %2.3f seconds, sending a second request' % (
+                method, url, delay))
+
+            pending.append(asyncio.ensure_future(send()))
+
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+
+                if succeeded or not pending:
+                    return (succeeded or list(done))[0].result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _send(self, method, url, data, headers, truncated_data, timing=None, endpoint=None):
+        attempt = 0
+
+        while True:
+            # the connection is not measured apart, it is part of ttfb
+            attempt_timing = timing.copy() if timing is not None else RequestTiming()
+
+            if self.rate_limiter is not None:
+                await asyncio.sleep(self.rate_limiter.reserve())
+
+            # raises the ImportError before aiohttp is needed for the options
+            session = self.session
+
+            options = {}
+            timeout = self._get_timeout(url)
+
+            if timeout is not None:
+                options['timeout'] = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+
+            ts = time.time()
+
+            family = self._acquire_circuit(method, url)
+
+            # signal:
+            request_started.send(url=url, data=truncated_data, headers=headers, method=method)
+
+            try:
+                sent_at = time.time()
+
+                async with session.request(method, url, data=data, headers=headers, **options) as response:
+                    headers_at = time.time()
+                    attempt_timing.ttfb = headers_at - sent_at
+
+                    content = await response.read()
+
+                    attempt_timing.download = time.time() - headers_at
+            except asyncio.TimeoutError as e:
+                self._finish_attempt(family, method, endpoint, ts, data, error=e)
+
+                delay = self._get_retry_delay(method, headers, attempt)
+
+                if delay is None:
+                    self._create_timeouterror(e, url)
+
+                self._retry(url, method, attempt, delay, error=e, endpoint=endpoint)
+            except connection_errors as e:
+                self._finish_attempt(family, method, endpoint, ts, data, error=e)
+
+                delay = self._get_retry_delay(method, headers, attempt)
+
+                if delay is None:
+                    self._create_connectionerror(e)
+
+                self._retry(url, method, attempt, delay, error=e, endpoint=endpoint)
+            except BaseException:
+                # cancelled calls free their slot without being counted
+                self._release_circuit(family)
+                raise
+            else:
+                result = AsyncResponse(response.status, response.headers, content, url=url)
+                self._finish_attempt(family, method, endpoint, ts, data, result=result)
+
+                if self.rate_limiter is not None:
+                    self.rate_limiter.update(result.headers)
+
+                delay = self._get_retry_delay(method, headers, attempt, result)
+
+                if delay is None:
+                    laps = time.time() - ts
+
+                    return self._process_response(result, url=url, data=truncated_data,
+                                                  headers=headers, method=method, laps=laps,
+                                                  timing=attempt_timing)
+
+                self._retry(url, method, attempt, delay, result=result, endpoint=endpoint)
+
+            await asyncio.sleep(delay)
+
+            attempt += 1
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+def get_async_handler(handler=None, fallback=None):
+    if handler is not None:
+        if not isinstance(handler, AsyncAPIRequest):
+            raise TypeError('%r is not an AsyncAPIRequest' % handler)
+
+        return handler
+
+    if isinstance(fallback, AsyncAPIRequest):
+        return fallback
+
+    # a default handler would keep an aiohttp session, and so its event loop, alive forever
+    raise TypeError('An AsyncAPIRequest handler is required, create one within your event loop')
+
+
+async def select_get(query, reference, handler=None, resource_model=None, deadline=None, **kwargs):
+    model = resource_model or query.model
+    handler = get_async_handler(handler, query._handler)
+
+    async def fetch():
+        url = query.get_url(reference, model, kwargs)
+
+        result, data = await handler.request(query.method, url, endpoint=query.get_object_endpoint(reference, model))
+
+        return query.parse_get(result, data, reference, model, url, handler)
+
+    def refresh():
+        if not handler.cache.claim_refresh(model, reference):
+            return
+
+        def done(task):
+            handler.cache.release_refresh(model, reference)
+
+            if not task.cancelled() and task.exception() is not None:
+                logger.warning('CACHE[%s] refresh failed: %s' % (handler.cache.get_key(model, reference),
+                                                                  task.exception()))
+
+        asyncio.ensure_future(fetch()).add_done_callback(done)
+
+    with query.start_span(handler, 'mangopay.get', model, query.get_object_endpoint(reference, model)):
+        instance = query.get_cached(reference, model, handler, refresh)
+
+        if instance is not None:
+            return instance
+
+        with deadline_context(deadline):
+            return await fetch()
+
+
+async def select_list(query, reference, resource_model, handler=None, deadline=None):
+    handler = get_async_handler(handler, query._handler)
+
+    with deadline_context(deadline):
+        result, data = await handler.request(query.method, query.get_list_url(reference, resource_model),
+                                             endpoint=query.get_list_endpoint(resource_model))
+
+        with query.measure_hydrate(result):
+            instances = query.parse_list(data, handler)
+
+        return await fetch_related(query, instances, handler)
+
+
+async def select_all(query, handler=None, deadline=None, **params):
+    handler = get_async_handler(handler, query._handler)
+
+    with deadline_context(deadline), query.start_span(handler, 'mangopay.all'):
+        url = query.parse_url(query.model._meta.url, params)
+        result, data = await handler.request(query.method, url, endpoint=query.get_endpoint(), **params)
+
+        with query.measure_hydrate(result):
+            instances = query.parse_all(result, data, url, handler)
+
+        return await fetch_related(query, instances, handler)
+
+
+async def fetch_related(query, instances, handler):
+    if not query.related or not instances:
+        return instances
+
+    references = query.get_related_references(instances)
+    semaphore = asyncio.Semaphore(query.related_workers)
+
+    async def fetch(reference):
+        model, pk = reference
+
+        async with semaphore:
+            try:
+                return await model.select().aget(pk, handler=handler)
+            except model.DoesNotExist:
+                return None
+
+    results = await asyncio.gather(*[fetch(reference) for reference in references])
+
+    query.attach_related(instances, dict((reference, instance) for reference, instance in zip(references, results)
+                                         if instance is not None))
+
+    return instances
+
+
+async def insert_execute(query, handler=None, idempotency_key=None, deadline=None):
+    handler = get_async_handler(handler, query._handler)
+
+    with deadline_context(deadline):
+        result, data = await handler.request(query.method,
+                                             query.get_url(),
+                                             data=query.parse_insert(),
+                                             headers=query.get_headers(idempotency_key),
+                                             endpoint=query.get_endpoint())
+
+    return query.parse_insert_result(result, data, handler)
+
+
+async def update_execute(query, handler=None, deadline=None):
+    handler = get_async_handler(handler, query._handler)
+
+    with deadline_context(deadline):
+        result, data = await handler.request(query.method,
+                                             query.get_url(),
+                                             data=query.parse_update(),
+                                             endpoint=query.get_endpoint())
+
+    return query.parse_update_result(result, data, handler)
+
+
+async def model_save(instance, handler=None, cls=None, deadline=None):
+    handler = get_async_handler(handler, instance._handler)
+    instance._handler = handler
+
+    if cls is None:
+        cls = instance.__class__
+
+    query, created = instance.get_save_query()
+
+    if query is None:
+        return {}
+
+    with instance.start_save_span(query, cls):
+        pre_save.send(cls, instance=instance)
+
+        result = await query.aexecute(handler, deadline=deadline)
+
+        return instance.finish_save(result, cls, created)
+
+
+async def model_create(model, **query):
+    handler = query.pop('handler', None)
+    deadline = query.pop('deadline', None)
+    inst = model(**query)
+    await inst.asave(handler, deadline=deadline)
+    return inst
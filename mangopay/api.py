@@ -2,18 +2,29 @@
 from __future__ import unicode_literals
 
 import requests
+import requests.adapters
 import base64
 import time
+import threading
 import logging
 import six
 import copy
+import re
 
-import mangopay
-from .exceptions import APIError, DecodeError, AuthenticationError
-from .signals import request_finished, request_started, request_error
-from .utils import reraise_as, truncatechars
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError, wait
 
-from requests.exceptions import ConnectionError
+import mangopay
+from .batch import Batch
+from .deadline import deadline_at, get_deadline, get_remaining
+from .exceptions import APIError, DecodeError, AuthenticationError, DeadlineExceeded, RequestTimeout
+from .identity import UnitOfWork
+from .signals import request_finished, request_started, request_error, request_retried
+from .timing import RequestTiming, TimingAdapter, measure, recording
+from .tracing import get_current_span, trace, use_span
+from .utils import reraise_as, truncatechars, SingleFlight
+
+from requests.exceptions import ConnectionError, Timeout
+from urllib3.exceptions import ReadTimeoutError
 
 try:
     import urllib.parse as urlrequest
@@ -28,11 +39,17 @@ except ImportError:
 
 logger = logging.getLogger('mangopay')
 
-requests_session = requests.Session()
+ENDPOINT_ID_RE = re.compile(r'/\d+(?=/|$)')
 
 
 class APIRequest(object):
-    def __init__(self, client_id=None, passphrase=None, api_url=None, api_sandbox_url=None, sandbox=True):
+    def __init__(self, client_id=None, passphrase=None, api_url=None, api_sandbox_url=None, sandbox=True,
+                 pool_connections=requests.adapters.DEFAULT_POOLSIZE,
+                 pool_maxsize=requests.adapters.DEFAULT_POOLSIZE,
+                 pool_block=requests.adapters.DEFAULT_POOLBLOCK,
+                 keep_alive_timeout=None, requests_session=None, retry_policy=None,
+                 rate_limiter=None, cache=None, single_flight=False, hedge_policy=None,
+                 connect_timeout=None, read_timeout=None, circuit_breaker=None, metrics=None, tracer=None):
         if sandbox:
             self.api_url = api_sandbox_url or mangopay.api_sandbox_url
         else:
@@ -41,6 +58,60 @@ class APIRequest(object):
         self.client_id = client_id or mangopay.client_id
         self.passphrase = passphrase or mangopay.passphrase
 
+        # pool_connections: number of host pools kept alive,
+        # pool_maxsize: connections kept alive per host,
+        # pool_block: wait for a free connection instead of opening an extra one,
+        # keep_alive_timeout: seconds a pooled connection may stay idle before being dropped
+        # (only on the session created by the handler).
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive_timeout = keep_alive_timeout
+
+        # seconds to wait for a connection and between two bytes of a response,
+        # lowered to what is left of the current deadline (see mangopay.deadline)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self.requests_session = requests_session or self._create_requests_session()
+
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+
+        if cache is not None:
+            cache.bind('%s@%s' % (self.client_id, self.api_url))
+
+        # concurrent identical GET calls share one request
+        self.in_flight = SingleFlight() if single_flight else None
+
+        self.hedge_policy = hedge_policy
+        self._hedge_executor = None
+        self._hedge_lock = threading.Lock()
+
+        self.circuit_breaker = circuit_breaker
+        self.metrics = metrics
+        self.tracer = tracer
+
+    def unit_of_work(self, identity_map=None):
+        return UnitOfWork(self, identity_map)
+
+    def batch(self, max_workers=8, rate=None, concurrency=None):
+        return Batch(self, max_workers=max_workers, rate=rate, concurrency=concurrency)
+
+    def _create_requests_session(self):
+        session = requests.Session()
+
+        adapter = TimingAdapter(pool_connections=self.pool_connections,
+                                pool_maxsize=self.pool_maxsize,
+                                pool_block=self.pool_block,
+                                keep_alive_timeout=self.keep_alive_timeout)
+
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        return session
+
     def _authorization(self):
         if self.client_id is None or self.passphrase is None:
             raise AuthenticationError(
@@ -56,7 +127,291 @@ class APIRequest(object):
 
         return 'Basic %s' % credentials
 
-    def request(self, method, url, data=None, **params):
+    def request(self, method, url, data=None, headers=None, endpoint=None, **params):
+        endpoint = endpoint or self._get_endpoint(url)
+
+        with trace(self.tracer, 'mangopay.request', {'http.method': method.upper(), 'http.route': endpoint}) as span:
+            timing = RequestTiming()
+            url, data, headers, truncated_data = self._prepare_request(method, url, data, headers, params, timing)
+
+            span.set_attribute('http.url', url)
+            span.set_attribute('http.request_content_length', self._get_size(data))
+
+            def send():
+                if self.hedge_policy is not None and method.upper() == 'GET':
+                    return self._send_hedged(method, url, data, headers, truncated_data, timing, endpoint)
+
+                return self._send(method, url, data, headers, truncated_data, timing, endpoint)
+
+            if self.in_flight is None or method.upper() != 'GET':
+                result, content = send()
+            else:
+                try:
+                    (result, content), shared = self.in_flight.do(self._get_flight_key(url, headers), send,
+                                                                  timeout=get_remaining())
+                except TimeoutError:
+                    self._create_deadlineerror(url)
+
+                if shared:
+                    # waiters get their own copy of the decoded response and of its timing
+                    result, content = self._copy_result(result), copy.deepcopy(content)
+
+            self._finish_span(span, result)
+
+            return result, content
+
+    def _copy_result(self, result):
+        timing = getattr(result, 'timing', None)
+        result = copy.copy(result)
+
+        if timing is not None:
+            # the queries of each waiter add their own hydration time
+            result.timing = timing.copy()
+
+        return result
+
+    def _finish_span(self, span, result):
+        span.set_attribute('http.status_code', result.status_code)
+        span.set_attribute('http.response_content_length', self._get_size(result.content))
+
+    def _get_size(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+
+        return len(data or b'')
+
+    def _get_flight_key(self, url, headers):
+        return url, tuple(sorted(headers.items()))
+
+    def _get_hedge_executor(self):
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(max_workers=self.hedge_policy.max_workers)
+
+            return self._hedge_executor
+
+    def _spawn(self, func):
+        # unlike the pool, a thread of its own never makes the call wait for a free worker
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+
+            try:
+                future.set_result(func())
+            except Exception as e:
+                future.set_exception(e)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+        return future
+
+    def _send_hedged(self, method, url, data, headers, truncated_data, timing=None, endpoint=None):
+        expires_at, span = get_deadline(), get_current_span()
+
+        def send():
+            ts = time.time()
+
+            with deadline_at(expires_at), use_span(span):
+                response = self._send(method, url, data, headers, truncated_data, timing, endpoint)
+
+            self.hedge_policy.record(time.time() - ts)
+
+            return response
+
+        delay = self.hedge_policy.get_delay()
+
+        if delay is None or not self.hedge_policy.can_hedge():
+            # the call cannot be hedged, no need to leave the calling thread
+            return send()
+
+        # the delay starts with the first attempt, the pool only runs hedges
+        pending = [self._spawn(send)]
+        done, not_done = wait(pending, timeout=delay)
+
+        if not done and self.hedge_policy.acquire():
+            logger.info('HEDGE[%s %s] no answer after %2.3f seconds, sending a second request' % (
+                method, url, delay))
+
+            pending.append(self._get_hedge_executor().submit(send))
+
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+
+            if succeeded or not pending:
+                # the loser cannot be interrupted once started, its answer is ignored
+                for future in pending:
+                    future.cancel()
+
+                return (succeeded or list(done))[0].result()
+
+    def _send(self, method, url, data, headers, truncated_data, timing=None, endpoint=None):
+        attempt = 0
+
+        while True:
+            # hedged calls run concurrently, each attempt gets its own record
+            attempt_timing = timing.copy() if timing is not None else RequestTiming()
+
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            timeout = self._get_timeout(url)
+
+            ts = time.time()
+
+            family = self._acquire_circuit(method, url)
+
+            # signal:
+            request_started.send(url=url, data=truncated_data, headers=headers, method=method)
+
+            try:
+                # the signal receivers and the circuit breaker are not server time
+                sent_at = time.time()
+
+                with recording(attempt_timing):
+                    result = self.requests_session.request(method, url,
+                                                           data=data,
+                                                           headers=headers,
+                                                           timeout=timeout,
+                                                           stream=True)
+
+                headers_at = time.time()
+                attempt_timing.ttfb = headers_at - sent_at - (attempt_timing.connect or 0)
+
+                # the body is read within the try so a failing download is retried too
+                result.content
+
+                attempt_timing.download = time.time() - headers_at
+            except Timeout as e:
+                self._finish_attempt(family, method, endpoint, ts, data, error=e)
+
+                delay = self._get_retry_delay(method, headers, attempt)
+
+                if delay is None:
+                    self._create_timeouterror(e, url)
+
+                self._retry(url, method, attempt, delay, error=e, endpoint=endpoint)
+            except ConnectionError as e:
+                self._finish_attempt(family, method, endpoint, ts, data, error=e)
+
+                delay = self._get_retry_delay(method, headers, attempt)
+
+                if delay is None:
+                    if self._is_read_timeout(e):
+                        self._create_timeouterror(e, url)
+
+                    self._create_connectionerror(e)
+
+                self._retry(url, method, attempt, delay, error=e, endpoint=endpoint)
+            except BaseException:
+                self._release_circuit(family)
+                raise
+            else:
+                self._finish_attempt(family, method, endpoint, ts, data, result=result)
+
+                if self.rate_limiter is not None:
+                    self.rate_limiter.update(result.headers)
+
+                delay = self._get_retry_delay(method, headers, attempt, result)
+
+                if delay is None:
+                    laps = time.time() - ts
+
+                    return self._process_response(result, url=url, data=truncated_data,
+                                                  headers=headers, method=method, laps=laps,
+                                                  timing=attempt_timing)
+
+                self._retry(url, method, attempt, delay, result=result, endpoint=endpoint)
+
+            time.sleep(delay)
+
+            attempt += 1
+
+    def _get_retry_delay(self, method, headers, attempt, result=None):
+        if self.retry_policy is None:
+            return None
+
+        return self.retry_policy.get_retry_delay(method, headers, attempt, result)
+
+    def _acquire_circuit(self, method, url):
+        if self.circuit_breaker is None:
+            return None
+
+        path = url[len(self._absolute_url('', '')):]
+        family = self.circuit_breaker.get_family(method, path)
+
+        self.circuit_breaker.acquire(family, url=url)
+
+        return family
+
+    def _release_circuit(self, family, result=None, error=None):
+        if family is None:
+            return
+
+        failed = None
+
+        if result is not None or error is not None:
+            failed = self.circuit_breaker.is_failure(result, error)
+
+        self.circuit_breaker.release(family, failed)
+
+    def _finish_attempt(self, family, method, endpoint, started_at, data, result=None, error=None):
+        self._release_circuit(family, result=result, error=error)
+
+        if self.metrics is None:
+            return
+
+        bytes_sent = self._get_size(data)
+
+        if result is None:
+            self.metrics.observe(method, endpoint, None, time.time() - started_at, bytes_sent=bytes_sent)
+        else:
+            self.metrics.observe(method, endpoint, result.status_code, time.time() - started_at,
+                                 bytes_sent=bytes_sent, bytes_received=self._get_size(result.content))
+
+    def _get_endpoint(self, url):
+        # calls made without the url template of their model get ids masked
+        return ENDPOINT_ID_RE.sub('/%(id)s', url.split('?', 1)[0])
+
+    def _get_timeout(self, url):
+        connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+        remaining = get_remaining()
+
+        if remaining is not None:
+            if remaining <= 0:
+                self._create_deadlineerror(url)
+
+            connect_timeout = min(connect_timeout or remaining, remaining)
+            read_timeout = min(read_timeout or remaining, remaining)
+
+        if connect_timeout is None and read_timeout is None:
+            return None
+
+        return connect_timeout, read_timeout
+
+    def _retry(self, url, method, attempt, delay, result=None, error=None, endpoint=None):
+        remaining = get_remaining()
+
+        if remaining is not None and delay >= remaining:
+            self._create_deadlineerror(url)
+
+        if self.metrics is not None:
+            self.metrics.observe_retry(method, endpoint or self._get_endpoint(url))
+
+        status_code = result.status_code if result is not None else None
+
+        logger.warning('RETRY[%s %s] attempt %d failed (status_code: %s | error: %s), retrying in %2.3f seconds' % (
+            method, url, attempt + 1, status_code, error, delay))
+
+        # signal:
+        request_retried.send(url=url, method=method, attempt=attempt + 1,
+                             delay=delay, status_code=status_code, error=error)
+
+    def _prepare_request(self, method, url, data, extra_headers, params, timing=None):
         params = params or {}
 
         headers = {
@@ -64,12 +419,16 @@ class APIRequest(object):
             'Content-Type': 'application/json'
         }
 
+        if extra_headers:
+            headers.update(extra_headers)
+
         truncated_data = None
 
         if data or data == {}:
             truncated_data = truncatechars(copy.copy(data))
 
-            data = json.dumps(data, default=lambda x: x.to_api_json())
+            with measure(timing, 'serialize'):
+                data = json.dumps(data, default=lambda x: x.to_api_json())
 
         encoded_params = urlrequest.urlencode(params)
 
@@ -80,34 +439,43 @@ class APIRequest(object):
         logger.info('DATA[IN -> %s]\n\t- headers: %s\n\t- content: %s' % (
             url, cleaned_headers, truncated_data))
 
-        ts = time.time()
+        return url, data, headers, truncated_data
 
-        # signal:
-        request_started.send(url=url, data=truncated_data, headers=headers, method=method)
+    def _process_response(self, result, url=None, data=None, headers=None, method=None, laps=None, timing=None):
+        if timing is not None:
+            result.timing = timing
 
-        try:
-            result = requests_session.request(method, url,
-                                              data=data,
-                                              headers=headers)
-        except ConnectionError as e:
-            msg = '{}'.format(e)
-
-            if msg:
-                msg = '%s: %s' % (type(e).__name__, msg)
-            else:
-                msg = type(e).__name__
+        succeeded = result.status_code in (requests.codes.ok, requests.codes.not_found,
+                                           requests.codes.created, requests.codes.accepted,
+                                           requests.codes.no_content)
+        content, decoded = None, True
+
+        # decoded before the signal, so it receives the time spent decoding
+        if succeeded and result.status_code != requests.codes.no_content:
+            decoded = False
+
+            if result.content:
+                try:
+                    content = result.content
+
+                    with measure(timing, 'decode'):
+                        if six.PY3:
+                            content = content.decode('utf-8')
 
-            reraise_as(APIError(msg))
+                        content = json.loads(content)
 
-        laps = time.time() - ts
+                    decoded = True
+                except ValueError:
+                    content = None
 
         # signal:
         request_finished.send(url=url,
-                              data=truncated_data,
+                              data=data,
                               headers=headers,
                               method=method,
                               result=result,
-                              laps=laps)
+                              laps=laps,
+                              timing=timing)
 
         logger.info('DATA[OUT -> %s][%2.3f seconds]\n\t- status_code: %s\n\t- headers: %s\n\t- content: %s' % (
             url,
@@ -117,25 +485,12 @@ class APIRequest(object):
             result.text if hasattr(result, 'text') else result.content)
         )
 
-        if result.status_code not in (requests.codes.ok, requests.codes.not_found,
-                                      requests.codes.created, requests.codes.accepted,
-                                      requests.codes.no_content):
-            self._create_apierror(result, url=url, data=truncated_data, method=method)
-        elif result.status_code == requests.codes.no_content:
-            return result, None
-        else:
-            if result.content:
-                try:
-                    content = result.content
+        if not succeeded:
+            self._create_apierror(result, url=url, data=data, method=method)
+        elif not decoded:
+            self._create_decodeerror(result, url=url)
 
-                    if six.PY3:
-                        content = content.decode('utf-8')
-
-                    return result, json.loads(content)
-                except ValueError:
-                    self._create_decodeerror(result, url=url)
-            else:
-                self._create_decodeerror(result, url=url)
+        return result, content
 
     def _absolute_url(self, url, encoded_params):
         pattern = '%s%s%s'
@@ -178,6 +533,31 @@ class APIRequest(object):
 
         raise APIError(text, code=status_code, content=content)
 
+    def _create_connectionerror(self, e):
+        msg = '{}'.format(e)
+
+        if msg:
+            msg = '%s: %s' % (type(e).__name__, msg)
+        else:
+            msg = type(e).__name__
+
+        reraise_as(APIError(msg))
+
+    def _is_read_timeout(self, e):
+        # requests wraps the read timeouts of a streamed body in a ConnectionError
+        return bool(e.args) and isinstance(e.args[0], ReadTimeoutError)
+
+    def _create_timeouterror(self, e, url=None):
+        remaining = get_remaining()
+
+        if remaining is not None and remaining <= 0:
+            self._create_deadlineerror(url)
+
+        reraise_as(RequestTimeout('%s: %s' % (type(e).__name__, e), url=url))
+
+    def _create_deadlineerror(self, url=None):
+        raise DeadlineExceeded('Deadline exceeded calling %s' % url, url=url)
+
     def _create_decodeerror(self, result, url=None):
 
         text = result.text if hasattr(result, 'text') else result.content
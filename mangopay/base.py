@@ -1,3 +1,4 @@
+import re
 import six
 
 from copy import deepcopy
@@ -5,6 +6,7 @@ from copy import deepcopy
 from .fields import PrimaryKeyField, FieldDescriptor, Field
 from .query import UpdateQuery, InsertQuery, SelectQuery
 from .signals import pre_save, post_save
+from .tracing import trace
 from .utils import force_text, force_str
 from . import get_default_handler
 
@@ -59,6 +61,65 @@ class BaseModelOptions(object):
 
             self.defaults[field] = field.default
 
+    def get_resource_name(self):
+        # subclasses sharing a resource (users, payins...) share its name
+        return getattr(self, 'verbose_name_plural', None) or self.model_name
+
+    def get_url_params(self, identifier):
+        url = getattr(self, 'url', None)
+
+        if isinstance(url, dict):
+            url = url.get(identifier)
+
+        return set(re.findall(r'%\((\w+)\)s', url or ''))
+
+    def compile_decoder(self):
+        # a later field sharing an api name wins, as in BaseQuery.get_field_transcription
+        transcription = dict((field.api_name, field) for field in self.fields.values())
+
+        self.decoder = dict((api_name, (field.name, field.get_python_converter()))
+                            for api_name, field in transcription.items())
+
+    def decode(self, result):
+        pairs = {}
+
+        if not result:
+            return pairs
+
+        decoder = self.decoder
+
+        for api_name, value in result.items():
+            entry = decoder.get(api_name)
+
+            if entry is None:
+                continue
+
+            name, converter = entry
+            pairs[name] = value if converter is None else converter(value)
+
+        return pairs
+
+    def compile_encoder(self):
+        self.encoder = dict((field.name, (field.api_name, field.required, field.get_api_converter()))
+                            for field in self.fields.values())
+
+    def encode(self, values):
+        pairs = {}
+        encoder = self.encoder
+
+        for name, value in six.iteritems(values):
+            entry = encoder.get(name)
+
+            if entry is None:
+                raise AttributeError('Field named %s not found' % name)
+
+            api_name, required, converter = entry
+
+            if required or value is not None:
+                pairs[api_name] = value if converter is None else converter(value)
+
+        return pairs
+
     def get_default_dict(self):
         dd = {}
         for field, default in self.defaults.items():
@@ -136,6 +197,8 @@ class ApiObjectBase(type):
 
         cls.DoesNotExist = exception_class
         cls._meta.prepared()
+        cls._meta.compile_decoder()
+        cls._meta.compile_encoder()
 
         return cls
 
@@ -145,6 +208,8 @@ class BaseApiModel(object):
 
     def __init__(self, *args, **kwargs):
         self._data = self._meta.get_default_dict()
+        self._dirty = set()
+        self._snapshots = {}
         self._handler = kwargs.pop('handler', None)
 
         for k, v in kwargs.items():
@@ -172,39 +237,84 @@ class BaseApiModel(object):
                 self.get_pk() and
                 other.get_pk() == self.get_pk())
 
-    def save(self, handler=None, cls=None):
+    def save(self, handler=None, cls=None, deadline=None):
         self._handler = handler or self.handler
 
-        field_dict = dict(self._data)
-        field_dict.update(self.get_field_dict())
-        field_dict.pop(self._meta.pk_name)
-
         if cls is None:
             cls = self.__class__
 
-        created = False
+        query, created = self.get_save_query()
+
+        if query is None:
+            return {}
+
+        with self.start_save_span(query, cls):
+            pre_save.send(cls, instance=self)
+
+            result = query.execute(self._handler, deadline=deadline)
 
-        pre_save.send(cls, instance=self)
+            return self.finish_save(result, cls, created)
+
+    def asave(self, handler=None, cls=None, deadline=None):
+        from .aio import model_save
+        return model_save(self, handler=handler, cls=cls, deadline=deadline)
+
+    def get_save_query(self):
+        """
+        Returns the query saving the instance and whether it creates it.
+        Existing instances only send the fields modified since they were
+        loaded, assigned or changed in place (plus the ones their url
+        needs); the query is ``None`` when nothing changed.
+        """
+        field_dict = self.get_field_dict()
+        field_dict.pop(self._meta.pk_name)
 
         if self.get_pk():
-            update = self.update(
-                self.get_pk(),
-                **field_dict
-            )
-            result = update.execute(handler)
-        else:
-            insert = self.insert(**field_dict)
-            result = insert.execute(handler)
+            dirty = self.get_dirty_fields().difference([self._meta.pk_name])
+
+            if not dirty:
+                return None, False
+
+            url_params = self._meta.get_url_params(UpdateQuery.identifier)
+
+            return self.update(self.get_pk(), **dict((name, value) for name, value in field_dict.items()
+                                                     if name in dirty or name in url_params)), False
+
+        return self.insert(**field_dict), True
 
-            created = True
+    def start_save_span(self, query, cls):
+        return trace(getattr(self._handler, 'tracer', None), 'mangopay.save', {
+            'mangopay.model': cls.__name__,
+            'mangopay.query': query.identifier,
+            'http.route': query.get_endpoint(),
+        })
 
+    def finish_save(self, result, cls, created):
         post_save.send(cls, instance=self, created=created)
 
         for key, value in result.items():
             setattr(self, key, value)
 
+        self.mark_clean()
+
         return result
 
+    def get_dirty_fields(self):
+        dirty = set(self._dirty)
+
+        for name, snapshot in self._snapshots.items():
+            if name not in dirty and self._meta.fields[name].api_value(self._data.get(name)) != snapshot:
+                dirty.add(name)
+
+        return dirty
+
+    def is_dirty(self):
+        return bool(self.get_dirty_fields())
+
+    def mark_clean(self):
+        self._dirty.clear()
+        self._snapshots.clear()
+
     @classmethod
     def select(cls, *args, **kwargs):
         return SelectQuery(cls, *args, **kwargs)
@@ -212,10 +322,16 @@ class BaseApiModel(object):
     @classmethod
     def create(cls, **query):
         handler = query.pop('handler', get_default_handler())
+        deadline = query.pop('deadline', None)
         inst = cls(**query)
-        inst.save(handler)
+        inst.save(handler, deadline=deadline)
         return inst
 
+    @classmethod
+    def acreate(cls, **query):
+        from .aio import model_create
+        return model_create(cls, **query)
+
     @classmethod
     def update(cls, reference, **query):
         return UpdateQuery(cls, reference, **query)
@@ -228,6 +344,10 @@ class BaseApiModel(object):
     def get(cls, *args, **kwargs):
         return cls.select().get(*args, **kwargs)
 
+    @classmethod
+    def aget(cls, *args, **kwargs):
+        return cls.select().aget(*args, **kwargs)
+
     def one(self, resource_model):
         return resource_model.select().get(self.get_pk(),
                                            resource_model=self.__class__,
@@ -238,10 +358,30 @@ class BaseApiModel(object):
                                             self.__class__,
                                             handler=self.handler)
 
+    def list_iterator(self, resource_model, per_page=100, prefetch=0):
+        return resource_model.select().list_iterator(self.get_pk(),
+                                                     self.__class__,
+                                                     handler=self.handler,
+                                                     per_page=per_page,
+                                                     prefetch=prefetch)
+
+    def alist(self, resource_model):
+        return resource_model.select().alist(self.get_pk(),
+                                             self.__class__,
+                                             handler=self._handler)
+
     @classmethod
     def all(cls, *args, **kwargs):
         return cls.select().all(*args, **kwargs)
 
+    @classmethod
+    def iterator(cls, *args, **kwargs):
+        return cls.select().iterator(*args, **kwargs)
+
+    @classmethod
+    def aall(cls, *args, **kwargs):
+        return cls.select().aall(*args, **kwargs)
+
     def get_pk(self):
         return getattr(self, self._meta.pk_name, None)
 
@@ -249,16 +389,19 @@ class BaseApiModel(object):
         return self._meta.fields[self._meta.pk_name]
 
     def get_field_dict(self):
-        def get_field_val(field):
+        set_defaults = not self.get_pk()
+        pairs = {}
+
+        for field in self._meta.fields.values():
             field_value = getattr(self, field.name)
-            if not self.get_pk() and field_value is None and field.default is not None:
+
+            if set_defaults and field_value is None and field.default is not None:
                 if callable(field.default):
                     field_value = field.default()
                 else:
                     field_value = field.default
                 setattr(self, field.name, field_value)
-            return (field.name, field_value)
 
-        pairs = map(get_field_val, self._meta.fields.values())
+            pairs[field.name] = field_value
 
-        return dict(pairs)
+        return pairs
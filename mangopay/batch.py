@@ -0,0 +1,182 @@
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .deadline import deadline_at, get_deadline
+from .exceptions import APIError, AuthenticationError, CircuitOpenError, DecodeError, RequestTimeout
+from .ratelimit import TokenBucket
+from .tracing import get_current_span, use_span
+
+
+class BatchResult(object):
+    __slots__ = ('value', 'error')
+
+    def __init__(self, value=None, error=None):
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return '<BatchResult: %r>' % (self.value,)
+
+        return '<BatchResult error: %r>' % (self.error,)
+
+
+class AdaptiveConcurrency(object):
+    """
+    An in-flight limit adjusted with AIMD (additive increase, multiplicative
+    decrease).
+
+    Each call completing in time raises the limit by ``increase`` per
+    window of ``limit`` calls, up to ``max_limit``. A call failing with a
+    429 or 5xx error, a timeout or a connection error, or taking more than
+    ``latency_tolerance`` times the usual latency (and at least
+    ``min_latency`` seconds), multiplies it by ``backoff`` down to
+    ``min_limit``; the calls started before a decrease cannot trigger
+    another one. Other failures leave the limit as it is.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, increase=1, backoff=0.5,
+                 latency_tolerance=2.0, min_latency=0.05, smoothing=0.1):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.min_latency = min_latency
+        self.smoothing = smoothing
+
+        self.value = float(initial)
+        self.in_flight = 0
+        self.latency = None
+        self.decreased_at = 0
+
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return max(self.min_limit, int(self.value))
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+
+            self.in_flight += 1
+
+    def is_overloaded(self, error):
+        if isinstance(error, RequestTimeout):
+            return True
+
+        if isinstance(error, (AuthenticationError, CircuitOpenError, DecodeError)):
+            # raised without the API struggling to answer
+            return False
+
+        # connection errors carry no status code
+        return isinstance(error, APIError) and (error.code is None or error.code == 429 or error.code >= 500)
+
+    def release(self, started_at, error=None):
+        latency = time.time() - started_at
+
+        with self._condition:
+            self.in_flight -= 1
+
+            slow = (self.latency is not None and latency > self.min_latency and
+                    latency > self.latency * self.latency_tolerance)
+
+            if error is None:
+                # slow calls count too, so a lasting latency increase becomes the new usual latency
+                self.latency = latency if self.latency is None else (
+                    self.latency + self.smoothing * (latency - self.latency))
+
+            if self.is_overloaded(error) or slow:
+                if started_at > self.decreased_at:
+                    self.value = max(self.min_limit, self.value * self.backoff)
+                    self.decreased_at = time.time()
+            elif error is None:
+                self.value = min(self.max_limit, self.value + self.increase / self.value)
+
+            self._condition.notify_all()
+
+
+class Batch(object):
+    """
+    Queues independent calls and runs them on a pool of ``max_workers``
+    threads, starting at most ``rate`` calls per second when set. Pass an
+    ``AdaptiveConcurrency`` as ``concurrency`` to let the number of calls in
+    flight follow the health of the API, within ``max_workers``.
+
+    ``run`` returns one ``BatchResult`` per queued call, in the order they
+    were queued, holding either the value returned or the exception raised.
+    Each call keeps the deadline and the tracing span active when it was
+    queued.
+    """
+
+    def __init__(self, handler, max_workers=8, rate=None, concurrency=None):
+        self.handler = handler
+        self.max_workers = max_workers
+        self.bucket = TokenBucket(rate, capacity=1) if rate else None
+        self.concurrency = concurrency
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def add(self, func, *args, **kwargs):
+        self.operations.append((func, args, kwargs, get_deadline(), get_current_span()))
+
+        return len(self.operations) - 1
+
+    def get(self, model, reference, **kwargs):
+        return self.add(model.select().get, reference, handler=self.handler, **kwargs)
+
+    def execute(self, query, **kwargs):
+        """
+        Queues an ``InsertQuery`` or an ``UpdateQuery``.
+        """
+        return self.add(query.execute, handler=self.handler, **kwargs)
+
+    def save(self, instance):
+        return self.add(instance.save, handler=self.handler)
+
+    def call(self, operation):
+        func, args, kwargs, expires_at, span = operation
+
+        if self.concurrency is not None:
+            self.concurrency.acquire()
+
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+        started_at = time.time()
+
+        try:
+            with deadline_at(expires_at), use_span(span):
+                result = BatchResult(value=func(*args, **kwargs))
+        except Exception as e:
+            result = BatchResult(error=e)
+
+        if self.concurrency is not None:
+            self.concurrency.release(started_at, result.error)
+
+            metrics = getattr(self.handler, 'metrics', None)
+
+            if metrics is not None:
+                metrics.set_gauge('concurrency_limit', self.concurrency.limit,
+                                  'Calls a batch lets in flight at once.')
+
+        return result
+
+    def run(self):
+        operations, self.operations = self.operations, []
+
+        if not operations:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(operations))) as executor:
+            return list(executor.map(self.call, operations))
@@ -0,0 +1,498 @@
+import collections
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import MappedFile
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+logger = logging.getLogger('mangopay')
+
+
+class CacheBackend(object):
+    """
+    Stores the JSON payloads of a ``ResponseCache`` as text keyed by
+    strings. ``get`` returns ``None`` for missing or expired entries and
+    backends count the live entries they drop to make room in
+    ``evictions``.
+    """
+
+    evictions = 0
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Keeps up to ``maxsize`` entries in the process, evicting the least
+    recently used one first.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.evictions = 0
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None or entry[0] <= time.time():
+                return None
+
+            self._entries[key] = entry
+
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Keeps up to ``maxsize`` entries in a SQLite database shared by the
+    processes of a host. The database runs in WAL mode so lookups do not
+    wait for a writer, except when they record the access of an entry for
+    the LRU order, which each entry does at most once every
+    ``touch_interval`` seconds. Each thread and process opens its own
+    connection.
+    """
+
+    def __init__(self, path, maxsize=10000, timeout=5, touch_interval=1):
+        self.path = path
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.touch_interval = touch_interval
+        self.evictions = 0
+
+        self._local = threading.local()
+
+        with self.connection as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS entries ('
+                               'key TEXT PRIMARY KEY, value TEXT, expires_at REAL, accessed_at REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)')
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        connection = self.connection
+
+        row = connection.execute('SELECT value, accessed_at FROM entries WHERE key = ? AND expires_at > ?',
+                                 (key, now)).fetchone()
+
+        if row is None:
+            return None
+
+        if now - row[1] >= self.touch_interval:
+            # the write lock is only taken once per interval for the hot entries
+            with connection:
+                connection.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (now, key))
+
+        return row[0]
+
+    def set(self, key, value, ttl):
+        now = time.time()
+
+        with self.connection as connection:
+            connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                               (key, value, now + ttl, now))
+            connection.execute('DELETE FROM entries WHERE expires_at <= ?', (now,))
+
+            excess = connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0] - self.maxsize
+
+            if excess > 0:
+                connection.execute('DELETE FROM entries WHERE key IN '
+                                   '(SELECT key FROM entries ORDER BY accessed_at LIMIT ?)', (excess,))
+                self.evictions += excess
+
+    def delete(self, key):
+        with self.connection as connection:
+            connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def clear(self):
+        with self.connection as connection:
+            connection.execute('DELETE FROM entries')
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM entries WHERE expires_at > ?',
+                                       (time.time(),)).fetchone()[0]
+
+
+class SharedMemoryBackend(CacheBackend):
+    """
+    Keeps entries in a memory-mapped file shared by every process opening
+    the same ``path``, split in ``slots`` fixed size slots. Each key maps to
+    a single slot, so storing it replaces whatever entry was there; values
+    longer than a slot are not cached.
+    """
+
+    header = struct.Struct('<dHI')
+
+    def __init__(self, path, slots=1024, slot_size=4096):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.evictions = 0
+
+        self.file = MappedFile(path, slots * slot_size)
+
+    def get_offset(self, key):
+        return (zlib.crc32(key) & 0xffffffff) % self.slots * self.slot_size
+
+    def read_slot(self, buf, offset):
+        expires_at, key_length, value_length = self.header.unpack_from(buf, offset)
+        start = offset + self.header.size
+
+        return expires_at, buf[start:start + key_length], start + key_length, value_length
+
+    def get(self, key):
+        key = key.encode('utf-8')
+        offset = self.get_offset(key)
+
+        with self.file.lock() as buf:
+            expires_at, slot_key, start, length = self.read_slot(buf, offset)
+
+            if slot_key != key or expires_at <= time.time():
+                return None
+
+            return buf[start:start + length].decode('utf-8')
+
+    def set(self, key, value, ttl):
+        key = key.encode('utf-8')
+        value = value.encode('utf-8')
+        offset = self.get_offset(key)
+
+        if self.header.size + len(key) + len(value) > self.slot_size:
+            return self.delete(key.decode('utf-8'))
+
+        now = time.time()
+
+        with self.file.lock() as buf:
+            expires_at, slot_key, start, length = self.read_slot(buf, offset)
+
+            if slot_key != key and expires_at > now:
+                self.evictions += 1
+
+            start = offset + self.header.size
+
+            self.header.pack_into(buf, offset, now + ttl, len(key), len(value))
+            buf[start:start + len(key) + len(value)] = key + value
+
+    def delete(self, key):
+        key = key.encode('utf-8')
+        offset = self.get_offset(key)
+
+        with self.file.lock() as buf:
+            if self.read_slot(buf, offset)[1] == key:
+                self.header.pack_into(buf, offset, 0, 0, 0)
+
+    def clear(self):
+        with self.file.lock() as buf:
+            for offset in range(0, self.slots * self.slot_size, self.slot_size):
+                self.header.pack_into(buf, offset, 0, 0, 0)
+
+    def __len__(self):
+        now = time.time()
+
+        with self.file.lock() as buf:
+            return sum(1 for offset in range(0, self.slots * self.slot_size, self.slot_size)
+                       if self.header.unpack_from(buf, offset)[0] > now)
+
+
+class BloomFilter(object):
+    """
+    A fixed size set of strings answering membership with no false
+    negatives and about ``error_rate`` false positives once ``capacity``
+    items were added.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+
+        self.bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def get_positions(self, item):
+        digest = hashlib.md5(item.encode('utf-8')).hexdigest()
+        first, second = int(digest[:16], 16), int(digest[16:], 16)
+
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        with self._lock:
+            for position in self.get_positions(item):
+                self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.get_positions(item))
+
+
+class ResponseCache(object):
+    """
+    A read-through cache of the payloads returned by ``SelectQuery.get``,
+    keyed by resource and primary key.
+
+    Payloads are stored as the JSON returned by the API in ``backend``
+    (a ``MemoryBackend`` holding ``maxsize`` entries by default) and models
+    are hydrated again on every hit. Entries expire after ``ttl`` seconds, or
+    after the value found in ``ttls`` for the model or its closest parent
+    class (``0`` disables caching for that model). Saving, inserting or
+    updating an object through a handler invalidates its entry.
+
+    With ``negative_ttl`` set, references answered by a 404 are remembered
+    for that many seconds and looking them up again raises ``DoesNotExist``
+    without calling the API. References seen in the responses of the API
+    are added to ``known_ids`` when a ``BloomFilter`` is given, and are
+    always looked up even if they were once missing.
+
+    Once expired, an entry can still be served for ``stale_ttl`` seconds
+    (or the value found in ``stale_ttls`` for the model) while it is
+    refreshed in the background by a pool of ``refresh_workers`` threads;
+    concurrent lookups of the same stale entry trigger a single refresh.
+
+    Keys are prefixed with ``namespace``, which defaults to the client id
+    and API url of the handler the cache is given to, so a backend shared by
+    several clients never mixes their objects. Handlers of different clients
+    can only share a cache given an explicit ``namespace``.
+    """
+
+    missing_prefix = 'missing:'
+
+    def __init__(self, maxsize=1024, ttl=60, ttls=None, backend=None, negative_ttl=None, known_ids=None,
+                 stale_ttl=0, stale_ttls=None, refresh_workers=4, namespace=None):
+        # an empty backend is falsy, it has a length
+        self.backend = backend if backend is not None else MemoryBackend(maxsize)
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.negative_ttl = negative_ttl
+        self.known_ids = known_ids
+        self.stale_ttl = stale_ttl
+        self.stale_ttls = stale_ttls or {}
+        self.refresh_workers = refresh_workers
+        self.namespace = namespace
+        self._bound_namespace = None
+
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.stale_hits = 0
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._executor = None
+
+    def __len__(self):
+        return len(self.backend)
+
+    @property
+    def evictions(self):
+        return self.backend.evictions
+
+    def bind(self, namespace):
+        """
+        Called by the handlers the cache is given to with their own
+        namespace, used when none was given.
+        """
+        if self.namespace is not None and self._bound_namespace is None:
+            return
+
+        with self._lock:
+            if self._bound_namespace is not None and self._bound_namespace != namespace:
+                raise ValueError('A ResponseCache shared by handlers of different clients needs a namespace')
+
+            self.namespace = self._bound_namespace = namespace
+
+    def get_key(self, model, reference):
+        key = '%s:%s' % (model._meta.get_resource_name(), reference)
+
+        if self.namespace is not None:
+            key = '%s:%s' % (self.namespace, key)
+
+        return key
+
+    def resolve(self, values, default, model):
+        for klass in model.__mro__:
+            if klass in values:
+                return values[klass]
+
+        return default
+
+    def get_ttl(self, model):
+        return self.resolve(self.ttls, self.ttl, model)
+
+    def get_stale_ttl(self, model):
+        return self.resolve(self.stale_ttls, self.stale_ttl, model)
+
+    def lookup(self, model, reference):
+        """
+        Returns the cached payload and whether it is stale, ``(None, False)``
+        when nothing usable is cached.
+        """
+        value = self.backend.get(self.get_key(model, reference))
+
+        if value is None:
+            with self._lock:
+                self.misses += 1
+
+            return None, False
+
+        fresh_until, data = json.loads(value)
+        stale = fresh_until <= time.time()
+
+        with self._lock:
+            self.hits += 1
+
+            if stale:
+                self.stale_hits += 1
+
+        return data, stale
+
+    def get(self, model, reference):
+        return self.lookup(model, reference)[0]
+
+    def set(self, model, reference, data):
+        ttl = self.get_ttl(model)
+
+        if ttl:
+            # the backend keeps the entry through its stale period
+            value = json.dumps([time.time() + ttl, data])
+
+            self.backend.set(self.get_key(model, reference), value, ttl + self.get_stale_ttl(model))
+
+    def claim_refresh(self, model, reference):
+        key = self.get_key(model, reference)
+
+        with self._lock:
+            if key in self._refreshing:
+                return False
+
+            self._refreshing.add(key)
+
+        return True
+
+    def release_refresh(self, model, reference):
+        with self._lock:
+            self._refreshing.discard(self.get_key(model, reference))
+
+    def revalidate(self, model, reference, refresh):
+        """
+        Calls ``refresh`` in the background unless the entry is already
+        being refreshed.
+        """
+        if not self.claim_refresh(model, reference):
+            return None
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.refresh_workers)
+
+        def run():
+            try:
+                refresh()
+            except Exception as e:
+                logger.warning('CACHE[%s] refresh failed: %s' % (self.get_key(model, reference), e))
+            finally:
+                self.release_refresh(model, reference)
+
+        return self._executor.submit(run)
+
+    def is_missing(self, model, reference):
+        if not self.negative_ttl:
+            return False
+
+        key = self.get_key(model, reference)
+
+        if self.known_ids is not None and key in self.known_ids:
+            return False
+
+        if self.backend.get(self.missing_prefix + key) is None:
+            return False
+
+        with self._lock:
+            self.negative_hits += 1
+
+        return True
+
+    def set_missing(self, model, reference):
+        key = self.get_key(model, reference)
+
+        self.backend.delete(key)
+
+        if self.negative_ttl:
+            self.backend.set(self.missing_prefix + key, '1', self.negative_ttl)
+
+    def add_known(self, model, reference):
+        if self.known_ids is not None and reference is not None:
+            self.known_ids.add(self.get_key(model, reference))
+
+    def invalidate(self, model, reference):
+        key = self.get_key(model, reference)
+
+        self.backend.delete(key)
+
+        if self.negative_ttl:
+            self.backend.delete(self.missing_prefix + key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'stale_hits': self.stale_hits,
+                'negative_hits': self.negative_hits, 'evictions': self.evictions, 'size': len(self)}
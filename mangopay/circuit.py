@@ -0,0 +1,166 @@
+import collections
+import logging
+import threading
+import time
+
+from .exceptions import CircuitOpenError
+from .signals import circuit_state_changed
+
+
+logger = logging.getLogger('mangopay')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class Circuit(object):
+    def __init__(self, window):
+        self.state = CLOSED
+        self.failures = 0
+        self.outcomes = collections.deque(maxlen=window)
+        self.opened_at = None
+        self.probes = 0
+        self.successes = 0
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to a failing part of the API.
+
+    Calls are grouped in families (``get_family``): reads share one, writes
+    are grouped by resource (``payins``, ``users``...). A family opens after
+    ``failure_threshold`` consecutive failures, or once ``error_ratio`` of
+    its last ``window`` calls failed (``min_calls`` at least). Calls to an
+    open family raise ``CircuitOpenError`` without being sent; after
+    ``reset_timeout`` seconds up to ``half_open_calls`` trial calls are let
+    through, which close it when they all succeed and reopen it otherwise.
+
+    Connection errors, timeouts and the ``status_forcelist`` responses are
+    failures, other answers (4xx included) are successes.
+    """
+
+    def __init__(self, failure_threshold=5, error_ratio=0.5, min_calls=20, window=100, reset_timeout=30,
+                 half_open_calls=1, status_forcelist=(500, 502, 503, 504), read_methods=('GET', 'HEAD', 'OPTIONS')):
+        self.failure_threshold = failure_threshold
+        self.error_ratio = error_ratio
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.status_forcelist = frozenset(status_forcelist)
+        self.read_methods = frozenset(method.upper() for method in read_methods)
+
+        self.circuits = {}
+
+        self._lock = threading.Lock()
+
+    def get_family(self, method, path):
+        """
+        Returns the family of a call to ``path``, relative to the client
+        url (``/payins/card/direct``).
+        """
+        if method.upper() in self.read_methods:
+            return 'reads'
+
+        return path.split('?', 1)[0].strip('/').split('/', 1)[0]
+
+    def get_state(self, family):
+        with self._lock:
+            circuit = self.circuits.get(family)
+
+            if circuit is None:
+                return CLOSED
+
+            return circuit.state
+
+    def is_failure(self, result=None, error=None):
+        if error is not None:
+            return True
+
+        return result.status_code in self.status_forcelist
+
+    def acquire(self, family, url=None):
+        """
+        Lets a call of ``family`` through or raises ``CircuitOpenError``.
+        Every call let through must be followed by ``release``.
+        """
+        with self._lock:
+            circuit = self.circuits.get(family)
+
+            if circuit is None:
+                circuit = self.circuits[family] = Circuit(self.window)
+
+            previous = circuit.state
+
+            if circuit.state == OPEN:
+                retry_after = circuit.opened_at + self.reset_timeout - time.time()
+
+                if retry_after > 0:
+                    raise CircuitOpenError('Circuit %s is open, retry in %2.3f seconds' % (family, retry_after),
+                                           url=url, family=family, retry_after=retry_after)
+
+                circuit.state = HALF_OPEN
+                circuit.probes = circuit.successes = 0
+
+            if circuit.state == HALF_OPEN:
+                if circuit.probes >= self.half_open_calls:
+                    raise CircuitOpenError('Circuit %s is half open, waiting for trial calls' % family,
+                                           url=url, family=family, retry_after=0)
+
+                circuit.probes += 1
+
+            state = circuit.state
+
+        self._changed(family, previous, state)
+
+    def release(self, family, failed=None):
+        """
+        Records the outcome of a call let through by ``acquire``;
+        ``failed=None`` frees its slot without counting it.
+        """
+        with self._lock:
+            circuit = self.circuits[family]
+            previous = circuit.state
+
+            if circuit.state == HALF_OPEN:
+                circuit.probes = max(0, circuit.probes - 1)
+
+                if failed:
+                    self._open(circuit)
+                elif failed is not None:
+                    circuit.successes += 1
+
+                    if circuit.successes >= self.half_open_calls:
+                        circuit.state = CLOSED
+                        circuit.failures = 0
+                        circuit.outcomes.clear()
+            elif circuit.state == CLOSED and failed is not None:
+                circuit.failures = circuit.failures + 1 if failed else 0
+                circuit.outcomes.append(failed)
+
+                if circuit.failures >= self.failure_threshold or self._is_failing(circuit):
+                    self._open(circuit)
+
+            state = circuit.state
+
+        self._changed(family, previous, state)
+
+    def _is_failing(self, circuit):
+        if len(circuit.outcomes) < self.min_calls:
+            return False
+
+        return sum(circuit.outcomes) >= self.error_ratio * len(circuit.outcomes)
+
+    def _open(self, circuit):
+        circuit.state = OPEN
+        circuit.opened_at = time.time()
+
+    def _changed(self, family, previous, state):
+        if previous == state:
+            return
+
+        logger.warning('CIRCUIT[%s] %s -> %s' % (family, previous, state))
+
+        # signal:
+        circuit_state_changed.send(self, family=family, previous=previous, state=state)
@@ -0,0 +1,53 @@
+import time
+
+from contextlib import contextmanager
+
+from .utils import ContextLocal
+
+
+_deadline = ContextLocal('mangopay_deadline')
+
+
+def get_deadline():
+    return _deadline.get()
+
+
+def get_remaining():
+    """
+    Returns the seconds left before the current deadline, ``None`` when
+    there is none.
+    """
+    expires_at = get_deadline()
+
+    if expires_at is None:
+        return None
+
+    return expires_at - time.time()
+
+
+@contextmanager
+def deadline_at(expires_at):
+    """
+    Runs the block with a deadline at the ``expires_at`` timestamp, or at
+    the current deadline if it is sooner.
+    """
+    current = get_deadline()
+
+    if expires_at is None or (current is not None and current < expires_at):
+        expires_at = current
+
+    token = _deadline.set(expires_at)
+
+    try:
+        yield expires_at
+    finally:
+        _deadline.reset(token)
+
+
+def deadline_context(timeout):
+    """
+    Gives the API calls made in the block ``timeout`` seconds in total;
+    nested blocks share what is left of the outer budget. ``None`` keeps the
+    current deadline.
+    """
+    return deadline_at(time.time() + timeout if timeout is not None else None)
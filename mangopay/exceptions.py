@@ -23,3 +23,19 @@ class AuthenticationError(APIError):
 
 class CurrencyMismatch(Exception):
     pass
+
+
+class RequestTimeout(APIError):
+    pass
+
+
+class DeadlineExceeded(RequestTimeout):
+    pass
+
+
+class CircuitOpenError(APIError):
+    def __init__(self, *args, **kwargs):
+        self.family = kwargs.pop('family', None)
+        self.retry_after = kwargs.pop('retry_after', None)
+
+        super(CircuitOpenError, self).__init__(*args, **kwargs)
@@ -1,6 +1,8 @@
+import copy
 import re
 import time
 import datetime
+import decimal
 import six
 
 from .utils import (Address, timestamp_from_datetime, timestamp_from_date,
@@ -8,19 +10,41 @@ from .utils import (Address, timestamp_from_datetime, timestamp_from_date,
 import sys
 
 
-class FieldDescriptor(object):
+# values which cannot change in place, the descriptor sees every change
+IMMUTABLE_TYPES = six.string_types + six.integer_types + (float, decimal.Decimal, datetime.date)
+
+
+class BaseFieldDescriptor(object):
     def __init__(self, field):
         self.field = field
         self.att_name = self.field.name
 
     def __get__(self, instance, instance_type=None):
         if instance is not None:
-            return instance._data.get(self.att_name)
+            value = instance._data.get(self.att_name)
+
+            if (value is not None and not isinstance(value, IMMUTABLE_TYPES) and
+                    self.att_name not in instance._snapshots and self.att_name not in instance._dirty):
+                # lists, Money, Address... can be changed in place once read, get_dirty_fields compares
+                # their API value with this copy
+                instance._snapshots[self.att_name] = copy.deepcopy(self.field.api_value(value))
+
+            return value
 
         return self.field
 
     def __set__(self, instance, value):
         instance._data[self.att_name] = value
+        instance._dirty.add(self.att_name)
+
+
+class FieldDescriptor(BaseFieldDescriptor):
+    pass
+
+
+# holds the id(s) behind a related field, not copied as a field on subclasses
+class RelatedIdDescriptor(BaseFieldDescriptor):
+    pass
 
 
 class Field(object):
@@ -74,6 +98,39 @@ class Field(object):
             value = self.python_value_callback(value)
         return value
 
+    def get_python_converter(self):
+        # None when API values are used as is
+        if self.python_value_callback is None and type(self).python_value == Field.python_value:
+            return None
+
+        return self.python_value
+
+    def get_api_converter(self):
+        # None when python values are sent as is
+        if self.api_value_callback is None and type(self).api_value == Field.api_value:
+            return None
+
+        return self.api_value
+
+
+def _int_or_none(value):
+    if value is not None:
+        return int(value)
+
+
+def _float_or_none(value):
+    if value is not None:
+        return float(value)
+
+
+def _pk_or_value(value):
+    get_pk = getattr(value, 'get_pk', None)
+
+    if get_pk is not None:
+        return get_pk()
+
+    return value
+
 
 class CharField(Field):
     def python_value(self, value):
@@ -86,6 +143,19 @@ class CharField(Field):
 
         return value
 
+    def get_python_converter(self):
+        if (sys.version_info > (3, 0) and self.python_value_callback is None and
+                type(self).python_value == CharField.python_value):
+            return None
+
+        return self.python_value
+
+    def get_api_converter(self):
+        if sys.version_info < (3, 0) and type(self).api_value == CharField.api_value:
+            return None
+
+        return self.api_value
+
     def api_value(self, value):
         if sys.version_info > (3, 0) and isinstance(value, six.binary_type):
             return value.decode('utf-8')
@@ -144,6 +214,19 @@ class IntegerField(Field):
         if value is not None:
             return int(super(IntegerField, self).python_value(value))
 
+    def get_python_converter(self):
+        if self.python_value_callback is None and type(self).python_value == IntegerField.python_value:
+            return _int_or_none
+
+        return self.python_value
+
+    def get_api_converter(self):
+        # null_wrapper(value, 0) always gives the value back
+        if self.api_value_callback is None and type(self).api_value == IntegerField.api_value:
+            return None
+
+        return self.api_value
+
 
 class FloatField(Field):
     def api_value(self, value):
@@ -153,6 +236,19 @@ class FloatField(Field):
         if value is not None:
             return float(super(FloatField, self).python_value(value))
 
+    def get_python_converter(self):
+        if self.python_value_callback is None and type(self).python_value == FloatField.python_value:
+            return _float_or_none
+
+        return self.python_value
+
+    def get_api_converter(self):
+        # null_wrapper(value, 0.0) always gives the value back
+        if self.api_value_callback is None and type(self).api_value == FloatField.api_value:
+            return None
+
+        return self.api_value
+
 
 class PrimaryKeyField(IntegerField):
     pass
@@ -246,7 +342,7 @@ class ForeignKeyField(IntegerField):
 
         klass._meta.rel_fields[name] = self.name
         setattr(klass, self.descriptor, ForeignRelatedObject(self.to, self.name))
-        setattr(klass, self.name, None)
+        setattr(klass, self.name, RelatedIdDescriptor(self))
 
         reverse_rel = ReverseForeignRelatedObject(klass, self.name)
         setattr(self.to, self.related_name, reverse_rel)
@@ -261,6 +357,12 @@ class ForeignKeyField(IntegerField):
 
         return value
 
+    def get_api_converter(self):
+        if self.api_value_callback is None and type(self).api_value == ForeignKeyField.api_value:
+            return _pk_or_value
+
+        return self.api_value
+
 
 class OneToOneField(ForeignKeyField):
     def add_to_class(self, klass, name):
@@ -275,7 +377,7 @@ class OneToOneField(ForeignKeyField):
 
         klass._meta.rel_fields[name] = self.name
         setattr(klass, self.descriptor, ForeignRelatedObject(self.to, self.name))
-        setattr(klass, self.name, None)
+        setattr(klass, self.name, RelatedIdDescriptor(self))
 
         reverse_rel = ReverseOneToOneRelatedObject(klass, self.name)
         setattr(self.to, self.related_name, reverse_rel)
@@ -321,6 +423,9 @@ class RelatedManager(object):
     def all(self):
         return self.instance.list(self.related_model)
 
+    def iterator(self, per_page=100, prefetch=0):
+        return self.instance.list_iterator(self.related_model, per_page=per_page, prefetch=prefetch)
+
 
 class ManyToManyField(ListField):
     def __init__(self, to, related_name=None, *args, **kwargs):
@@ -341,7 +446,7 @@ class ManyToManyField(ListField):
 
         klass._meta.rel_fields[name] = self.name
         setattr(klass, self.descriptor, ManyToManyRelatedObject(self.to, self.name))
-        setattr(klass, self.name, None)
+        setattr(klass, self.name, RelatedIdDescriptor(self))
 
         reverse_rel = ManyToManyRelatedObject(klass, self.name)
 
@@ -365,12 +470,20 @@ class ManyToManyRelatedObject(object):
     def __init__(self, related_model, name):
         self.related_model = related_model
         self.field_name = name
+        self.cache_name = '_cache_%s' % name
 
     def __get__(self, instance, instance_type=None):
+        # filled by SelectQuery.prefetch_related
+        cached = getattr(instance, self.cache_name, None)
+
+        if cached is not None:
+            return cached
+
         return instance.list(self.related_model)
 
     def __set__(self, instance, objs):
         setattr(instance, self.field_name, [obj.get_pk() for obj in objs])
+        setattr(instance, self.cache_name, list(objs))
 
 
 class BirthplaceField(Field):
@@ -0,0 +1,65 @@
+import collections
+import threading
+
+
+class HedgePolicy(object):
+    """
+    Decides when a slow GET call is hedged with a second identical request.
+
+    Once ``min_samples`` calls were measured, a call still running after the
+    ``percentile`` of the last ``window`` latencies is sent again and the
+    first answer wins. Every call earns ``budget`` hedge tokens (up to
+    ``max_tokens``) and each hedge spends one, so hedges never exceed that
+    fraction of the calls, and so of the rate limit they count against.
+    At most ``max_workers`` hedges run at once.
+    """
+
+    def __init__(self, percentile=95, min_samples=20, window=200, budget=0.05, max_tokens=10,
+                 min_delay=0.01, max_workers=16):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.budget = budget
+        self.max_tokens = max_tokens
+        self.min_delay = min_delay
+        self.max_workers = max_workers
+
+        self.latencies = collections.deque(maxlen=window)
+        self.tokens = 0.0
+        self.hedges = 0
+
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+
+    def get_delay(self):
+        """
+        Returns how long to wait for a call before hedging it, ``None``
+        while too few latencies were measured.
+        """
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.budget)
+
+            if len(self.latencies) < self.min_samples:
+                return None
+
+            latencies = sorted(self.latencies)
+
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))
+
+        return max(self.min_delay, latencies[index])
+
+    def can_hedge(self):
+        with self._lock:
+            return self.tokens >= 1
+
+    def acquire(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+            self.hedges += 1
+
+        return True
@@ -0,0 +1,89 @@
+import threading
+
+from .batch import Batch
+from .utils import SingleFlight
+
+
+class IdentityMap(object):
+    """
+    Maps each (resource, primary key) to a single model instance. ``load``
+    makes sure a reference is fetched at most once, threads asking for a
+    reference being loaded wait for that request instead of sending theirs.
+    """
+
+    def __init__(self):
+        self.instances = {}
+
+        self._loading = SingleFlight()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.instances)
+
+    def __contains__(self, instance):
+        return self.get_key(instance.__class__, instance.get_pk()) in self.instances
+
+    def get_key(self, model, reference):
+        return model._meta.get_resource_name(), str(reference)
+
+    def get(self, model, reference):
+        return self.instances.get(self.get_key(model, reference))
+
+    def add(self, instance):
+        """
+        Registers ``instance`` and returns it, or returns the instance
+        already registered for the same reference.
+        """
+        if instance.get_pk() is None:
+            return instance
+
+        with self._lock:
+            return self.instances.setdefault(self.get_key(instance.__class__, instance.get_pk()), instance)
+
+    def discard(self, model, reference):
+        with self._lock:
+            self.instances.pop(self.get_key(model, reference), None)
+
+    def load(self, model, reference, fetch):
+        key = self.get_key(model, reference)
+
+        with self._lock:
+            if key in self.instances:
+                return self.instances[key]
+
+        def load():
+            # the previous load may have finished since the map was checked
+            return self.instances.get(key) or self.add(fetch())
+
+        return self._loading.do(key, load)[0]
+
+    def clear(self):
+        with self._lock:
+            self.instances.clear()
+
+
+class UnitOfWork(object):
+    """
+    A handler keeping the objects it hydrates in an ``IdentityMap``.
+
+    Objects fetched or listed through it carry it as their handler, so the
+    related objects they resolve (``transaction.author``,
+    ``transfer.credited_wallet``...) are shared between them and fetched
+    once. Everything else is delegated to the wrapped handler.
+    """
+
+    def __init__(self, handler, identity_map=None):
+        self.handler = handler
+        self.identity_map = identity_map or IdentityMap()
+
+    def __getattr__(self, name):
+        return getattr(self.handler, name)
+
+    def batch(self, max_workers=8, rate=None, concurrency=None):
+        return Batch(self, max_workers=max_workers, rate=rate, concurrency=concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.identity_map.clear()
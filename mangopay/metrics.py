@@ -0,0 +1,163 @@
+import bisect
+import collections
+import threading
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # the last slot counts the values above every bucket (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        """
+        Returns ``(upper bound, count)`` pairs, each count including the
+        values of the lower buckets; the last bound is ``None`` (+Inf).
+        """
+        total = 0
+        counts = []
+
+        for bound, count in zip(self.buckets + (None, ), self.counts):
+            total += count
+            counts.append((bound, total))
+
+        return counts
+
+
+class MetricsRegistry(object):
+    """
+    Collects metrics about the HTTP calls of the handlers it is given to
+    (``APIRequest(metrics=registry)``).
+
+    Every attempt counts as a request, labelled by method, endpoint and
+    status; the endpoint is the url template of the model (``Meta.url``,
+    ``/users/%(user_id)s/transactions``), ids being replaced with
+    ``%(id)s``. The status of an attempt which got no response is
+    ``error``. Gauges hold a single current value, such as the in-flight
+    limit of the batches using an ``AdaptiveConcurrency``.
+    ``generate_latest`` renders the registry in the Prometheus text format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, namespace='mangopay'):
+        self.buckets = buckets
+        self.namespace = namespace
+
+        self.requests = collections.defaultdict(int)
+        self.errors = collections.defaultdict(int)
+        self.latencies = {}
+        self.bytes_sent = collections.defaultdict(int)
+        self.bytes_received = collections.defaultdict(int)
+        self.retries = collections.defaultdict(int)
+        self.gauges = {}
+
+        self._lock = threading.Lock()
+
+    def observe(self, method, endpoint, status, latency, bytes_sent=0, bytes_received=0):
+        """
+        Records an attempt; ``status`` is the status code of the response,
+        ``None`` when none was received.
+        """
+        key = (method.upper(), endpoint)
+        status = 'error' if status is None else str(status)
+
+        with self._lock:
+            self.requests[key + (status, )] += 1
+
+            if status == 'error' or int(status) >= 400:
+                self.errors[key + (status, )] += 1
+
+            if key not in self.latencies:
+                self.latencies[key] = Histogram(self.buckets)
+
+            self.latencies[key].observe(latency)
+
+            self.bytes_sent[key] += bytes_sent
+            self.bytes_received[key] += bytes_received
+
+    def observe_retry(self, method, endpoint):
+        with self._lock:
+            self.retries[(method.upper(), endpoint)] += 1
+
+    def set_gauge(self, name, value, help=''):
+        with self._lock:
+            self.gauges[name] = (help, value)
+
+    def clear(self):
+        with self._lock:
+            for metric in (self.requests, self.errors, self.latencies, self.bytes_sent, self.bytes_received,
+                           self.retries, self.gauges):
+                metric.clear()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+
+def _format_value(value):
+    if value is None:
+        return '+Inf'
+
+    return repr(float(value))
+
+
+def generate_latest(registry):
+    """
+    Returns the metrics of ``registry`` in the Prometheus text exposition
+    format (version 0.0.4).
+    """
+    lines = []
+
+    def add(name, kind, help, samples):
+        name = '%s_%s' % (registry.namespace, name)
+
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+        for suffix, labels, values, value in samples:
+            lines.append('%s%s%s %s' % (name, suffix, _format_labels(labels, values), _format_value(value)))
+
+    with registry._lock:
+        counters = (
+            ('requests_total', 'HTTP calls sent to the MangoPay API.', registry.requests, ('status', )),
+            ('errors_total', 'HTTP calls which failed or got an error status.', registry.errors, ('status', )),
+            ('request_bytes_total', 'Bytes of payload sent.', registry.bytes_sent, ()),
+            ('response_bytes_total', 'Bytes of response body received.', registry.bytes_received, ()),
+            ('retries_total', 'HTTP calls retried.', registry.retries, ()),
+        )
+
+        for name, help, metric, labels in counters:
+            add(name, 'counter', help,
+                [('', ('method', 'endpoint') + labels, key, value) for key, value in sorted(metric.items())])
+
+        samples = []
+
+        for key, histogram in sorted(registry.latencies.items()):
+            for bound, count in histogram.get_cumulative_counts():
+                samples.append(('_bucket', ('method', 'endpoint', 'le'), key + (_format_value(bound), ), count))
+
+            samples.append(('_sum', ('method', 'endpoint'), key, histogram.sum))
+            samples.append(('_count', ('method', 'endpoint'), key, histogram.count))
+
+        add('request_duration_seconds', 'histogram', 'Duration of the HTTP calls in seconds.', samples)
+
+        for name, (help, value) in sorted(registry.gauges.items()):
+            add(name, 'gauge', help or name, [('', (), (), value)])
+
+    return '\n'.join(lines) + '\n'
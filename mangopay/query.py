@@ -1,6 +1,13 @@
 from . import get_default_handler
+from .deadline import deadline_context, deadline_at, get_deadline
+from .retry import IDEMPOTENCY_HEADER
+from .timing import measure
+from .tracing import get_current_span, trace, use_span
 
-import six
+import collections
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
 
 
 class BaseQuery(object):
@@ -18,15 +25,41 @@ class BaseQuery(object):
         return dict((field.api_name, field.name) for field in model_klass._meta.fields.values())
 
     def parse_result(self, result, model_klass=None):
-        pairs = {}
         model_klass = model_klass or self.model
 
-        for api_name, field_name in self.get_field_transcription(model_klass).items():
-            field = model_klass._meta.get_field_by_name(field_name)
-            if result and api_name in result:
-                pairs[field_name] = field.python_value(result[api_name])
+        return model_klass._meta.decode(result)
+
+    def start_span(self, handler, name, model=None, endpoint=None):
+        return trace(getattr(handler, 'tracer', None), name, {
+            'mangopay.model': (model or self.model).__name__,
+            'mangopay.query': self.identifier,
+            'http.route': endpoint or self.get_endpoint(model),
+        })
+
+    def measure_hydrate(self, result):
+        return measure(getattr(result, 'timing', None), 'hydrate')
+
+    def hydrate(self, data, handler, model_klass=None):
+        model_klass = model_klass or self.model
+
+        instance = model_klass(handler=handler, **model_klass._meta.decode(data))
+        instance.mark_clean()
+
+        cache = getattr(handler, 'cache', None)
+
+        if cache is not None:
+            cache.add_known(model_klass, instance.get_pk())
+
+        identity_map = getattr(handler, 'identity_map', None)
 
-        return pairs
+        if identity_map is not None:
+            instance = identity_map.add(instance)
+
+        return instance
+
+    def get_endpoint(self, model=None):
+        # the unfilled url template, labelling the metrics
+        return self.parse_url((model or self.model)._meta.url)
 
     def parse_url(self, meta_url, params=None):
         if isinstance(meta_url, dict):
@@ -40,53 +73,380 @@ class BaseQuery(object):
         return url
 
 
+# lazily walks the pages of a list endpoint, prefetching the next ones in a thread pool
+class PaginatedIterator(object):
+    def __init__(self, handler, url, parse_entry, per_page=100, page=1, params=None, prefetch=0,
+                 prepare_page=None, endpoint=None):
+        self.handler = handler
+        self.url = url
+        self.endpoint = endpoint
+        self.parse_entry = parse_entry
+        self.prepare_page = prepare_page
+        self.per_page = per_page
+        self.page = page
+        self.params = params or {}
+        self.prefetch = prefetch
+
+        self.number_of_pages = None
+        self.number_of_items = None
+
+    def fetch_page(self, page):
+        result, data = self.handler.request('GET', self.url, endpoint=self.endpoint, page=page,
+                                            per_page=self.per_page, **self.params)
+
+        if 'errors' in data:
+            self.handler._create_apierror(result, self.url)
+
+        return result, data
+
+    def read_headers(self, result):
+        for header, attr in (('X-Number-Of-Pages', 'number_of_pages'),
+                             ('X-Number-Of-Items', 'number_of_items')):
+            value = result.headers.get(header)
+
+            if value is not None:
+                setattr(self, attr, int(value))
+
+    def is_last_page(self, page, data):
+        if not data:
+            return True
+
+        if self.number_of_pages is not None:
+            return page >= self.number_of_pages
+
+        return len(data) < self.per_page
+
+    def iter_pages(self):
+        page = self.page
+
+        result, data = self.fetch_page(page)
+        self.read_headers(result)
+
+        if self.prefetch and self.number_of_pages is not None:
+            yield data
+
+            for data in self.prefetch_pages(page + 1, self.number_of_pages):
+                yield data
+
+            return
+
+        while True:
+            yield data
+
+            if self.is_last_page(page, data):
+                return
+
+            page += 1
+
+            result, data = self.fetch_page(page)
+            self.read_headers(result)
+
+    def prefetch_pages(self, first, last):
+        futures = collections.deque()
+        next_page = first
+        expires_at, span = get_deadline(), get_current_span()
+
+        def fetch_page(page):
+            with deadline_at(expires_at), use_span(span):
+                return self.fetch_page(page)
+
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            try:
+                while futures or next_page <= last:
+                    while next_page <= last and len(futures) < self.prefetch:
+                        futures.append(executor.submit(fetch_page, next_page))
+                        next_page += 1
+
+                    result, data = futures.popleft().result()
+
+                    yield data
+            finally:
+                # the consumer stopped early or a page failed, drop what has not started yet
+                for future in futures:
+                    future.cancel()
+
+    def __iter__(self):
+        for data in self.iter_pages():
+            if self.prepare_page is None:
+                for entry in data:
+                    yield self.parse_entry(entry)
+            else:
+                instances = [self.parse_entry(entry) for entry in data]
+                self.prepare_page(instances)
+
+                for instance in instances:
+                    yield instance
+
+
 class SelectQuery(BaseQuery):
     identifier = 'SELECT'
 
     def __init__(self, model, *args, **kwargs):
         super(SelectQuery, self).__init__(model, 'GET')
 
-    def get(self, reference, handler=None, resource_model=None, **kwargs):
+        self.related = []
+        self.related_workers = 8
+
+    def get_related_field(self, name, field_class):
+        from .fields import ManyToManyField
+
+        if name not in self.model._meta.rel_fields:
+            raise AttributeError('Field named %s not found' % name)
+
+        field = self.model._meta.fields[self.model._meta.rel_fields[name]]
+
+        if isinstance(field, ManyToManyField) is not (field_class is ManyToManyField):
+            raise ValueError('%s is not a %s' % (name, field_class.__name__))
+
+        return field
+
+    def select_related(self, *names):
+        # fetches each distinct reference once, concurrently
+        from .fields import ForeignKeyField
+
+        for name in names:
+            self.related.append(self.get_related_field(name, ForeignKeyField))
+
+        return self
+
+    def prefetch_related(self, *names):
+        # a list is only prefetched when every object it refers to was found
+        from .fields import ManyToManyField
+
+        for name in names:
+            self.related.append(self.get_related_field(name, ManyToManyField))
+
+        return self
+
+    def get_related_references(self, instances):
+        references = collections.OrderedDict()
+
+        for instance in instances:
+            for field in self.related:
+                for reference in self.get_field_references(instance, field):
+                    references[(field.to, reference)] = None
+
+        return list(references)
+
+    def get_field_references(self, instance, field):
+        value = getattr(instance, field.name, None)
+
+        if isinstance(value, (list, tuple)):
+            return [reference for reference in value if reference]
+
+        return [value] if value else []
+
+    def attach_related(self, instances, objects):
+        from .fields import ManyToManyField
+
+        for instance in instances:
+            for field in self.related:
+                references = self.get_field_references(instance, field)
+                related = [objects[(field.to, reference)] for reference in references
+                           if (field.to, reference) in objects]
+
+                if isinstance(field, ManyToManyField):
+                    # a partial list would hide the missing objects, they are left lazy
+                    if len(related) == len(references):
+                        setattr(instance, '_cache_%s' % field.name, related)
+                elif related:
+                    setattr(instance, '_cache_%s' % field.name, related[0])
+
+    def fetch_related(self, instances, handler):
+        if not self.related or not instances:
+            return instances
+
+        references = self.get_related_references(instances)
+        expires_at, span = get_deadline(), get_current_span()
+
+        def fetch(reference):
+            model, pk = reference
+
+            try:
+                with deadline_at(expires_at), use_span(span):
+                    return model.select().get(pk, handler=handler)
+            except model.DoesNotExist:
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(self.related_workers, len(references))) as executor:
+            objects = dict((reference, instance)
+                           for reference, instance in zip(references, executor.map(fetch, references))
+                           if instance is not None)
+
+        self.attach_related(instances, objects)
+
+        return instances
+
+    def get(self, reference, handler=None, resource_model=None, deadline=None, **kwargs):
         model = resource_model or self.model
         handler = handler or self.handler
 
-        meta_url = self.parse_url(model._meta.url, kwargs)
+        def fetch():
+            url = self.get_url(reference, model, kwargs)
+
+            result, data = handler.request(self.method, url, endpoint=self.get_object_endpoint(reference, model))
+
+            return self.parse_get(result, data, reference, model, url, handler)
+
+        def refresh():
+            handler.cache.revalidate(model, reference, fetch)
+
+        def load():
+            instance = self.get_cached(reference, model, handler, refresh)
+
+            if instance is not None:
+                return instance
+
+            return fetch()
+
+        identity_map = getattr(handler, 'identity_map', None)
+
+        with deadline_context(deadline), self.start_span(handler, 'mangopay.get', model,
+                                                         self.get_object_endpoint(reference, model)):
+            if identity_map is not None:
+                return identity_map.load(model, reference, load)
+
+            return load()
+
+    def aget(self, reference, handler=None, resource_model=None, deadline=None, **kwargs):
+        from .aio import select_get
+        return select_get(self, reference, handler=handler, resource_model=resource_model, deadline=deadline,
+                          **kwargs)
+
+    def get_url(self, reference, model, params=None):
+        meta_url = self.parse_url(model._meta.url, params)
         if reference != "":
-            url = '%s/%s' % (meta_url, reference)
-        else:
-            url = '%s' % meta_url
+            return '%s/%s' % (meta_url, reference)
+
+        return '%s' % meta_url
 
-        result, data = handler.request(self.method, url)
+    def get_object_endpoint(self, reference, model):
+        endpoint = self.get_endpoint(model)
+
+        if reference != "":
+            return '%s/%%(id)s' % endpoint
+
+        return endpoint
+
+    def get_cached(self, reference, model, handler, refresh=None):
+        cache = getattr(handler, 'cache', None)
+
+        if cache is None:
+            return None
+
+        if cache.is_missing(model, reference):
+            self.raise_does_not_exist(model, reference)
+
+        data, stale = cache.lookup(model, reference)
+
+        if data is None:
+            return None
+
+        if stale and refresh is not None:
+            refresh()
+
+        cast = getattr(model, 'cast', lambda result: model)
+
+        return self.hydrate(data, handler, cast(data))
+
+    def raise_does_not_exist(self, model, reference):
+        raise model.DoesNotExist('instance %s matching reference %s does not exist' % (model._meta.model_name,
+                                                                                       reference))
+
+    def parse_get(self, result, data, reference, model, url, handler):
+        cache = getattr(handler, 'cache', None)
 
         if 'errors' in data:
             if result.status_code == 404:
-                raise model.DoesNotExist('instance %s matching reference %d does not exist' % (model._meta.model_name,
-                                                                                               reference))
+                if cache is not None:
+                    cache.set_missing(model, reference)
+
+                self.raise_does_not_exist(model, reference)
             else:
                 return handler._create_apierror(result, url)
 
+        if cache is not None:
+            cache.set(model, reference, data)
+
         cast = getattr(model, 'cast', lambda result: model)
-        model_klass = cast(data)
 
-        return model_klass(handler=handler,
-                           **dict(self.parse_result(data, model_klass)))
+        # the cache write above is not part of the hydration
+        with self.measure_hydrate(result):
+            return self.hydrate(data, handler, cast(data))
 
-    def list(self, reference, resource_model, handler=None):
+    def list(self, reference, resource_model, handler=None, deadline=None):
+        with deadline_context(deadline):
+            handler = handler or self.handler
+
+            result, data = handler.request(self.method, self.get_list_url(reference, resource_model),
+                                           endpoint=self.get_list_endpoint(resource_model))
+
+            with self.measure_hydrate(result):
+                instances = self.parse_list(data, handler)
+
+            return self.fetch_related(instances, handler)
+
+    def alist(self, reference, resource_model, handler=None, deadline=None):
+        from .aio import select_list
+        return select_list(self, reference, resource_model, handler=handler, deadline=deadline)
+
+    def get_list_url(self, reference, resource_model):
+        return '/%s/%d/%s' % (resource_model._meta.verbose_name_plural, reference,
+                              self.model._meta.verbose_name_plural)
+
+    def get_list_endpoint(self, resource_model):
+        return '/%s/%%(id)s/%s' % (resource_model._meta.verbose_name_plural, self.model._meta.verbose_name_plural)
+
+    def parse_list(self, data, handler):
+        return [self.hydrate(entry, handler) for entry in data]
+
+    def list_iterator(self, reference, resource_model, handler=None, per_page=100, prefetch=0):
         handler = handler or self.handler
 
-        result, data = handler.request(self.method,
-                                       '/%s/%d/%s' % (resource_model._meta.verbose_name_plural, reference,
-                                                      self.model._meta.verbose_name_plural))
+        def parse_entry(entry):
+            return self.hydrate(entry, handler)
 
-        return [self.model(handler=handler,
-                           **dict(self.parse_result(entry))) for entry in data]
+        def prepare_page(instances):
+            self.fetch_related(instances, handler)
 
-    def all(self, handler=None, **params):
+        return PaginatedIterator(handler, self.get_list_url(reference, resource_model), parse_entry,
+                                 per_page=per_page, prefetch=prefetch,
+                                 prepare_page=prepare_page if self.related else None,
+                                 endpoint=self.get_list_endpoint(resource_model))
+
+    def all(self, handler=None, deadline=None, **params):
+        handler = handler or self.handler
+
+        with deadline_context(deadline), self.start_span(handler, 'mangopay.all'):
+            url = self.parse_url(self.model._meta.url, params)
+            result, data = handler.request(self.method, url, endpoint=self.get_endpoint(), **params)
+
+            with self.measure_hydrate(result):
+                instances = self.parse_all(result, data, url, handler)
+
+            return self.fetch_related(instances, handler)
+
+    def aall(self, handler=None, deadline=None, **params):
+        from .aio import select_all
+        return select_all(self, handler=handler, deadline=deadline, **params)
+
+    def iterator(self, handler=None, per_page=100, page=1, prefetch=0, **params):
         handler = handler or self.handler
 
         url = self.parse_url(self.model._meta.url, params)
-        result, data = handler.request(self.method, url, **params)
+        cast = getattr(self.model, 'cast', lambda result: self.model)
 
+        def parse_entry(entry):
+            return self.hydrate(entry, handler, cast(entry))
+
+        def prepare_page(instances):
+            self.fetch_related(instances, handler)
+
+        return PaginatedIterator(handler, url, parse_entry, per_page=per_page, page=page, params=params,
+                                 prefetch=prefetch, prepare_page=prepare_page if self.related else None,
+                                 endpoint=self.get_endpoint())
+
+    def parse_all(self, result, data, url, handler):
         if 'errors' in data:
             return handler._create_apierror(result, url)
 
@@ -94,8 +454,7 @@ class SelectQuery(BaseQuery):
         cast = getattr(self.model, 'cast', lambda result: self.model)
 
         for entry in data:
-            model_klass = cast(entry)
-            results.append(model_klass(handler=handler, **dict(self.parse_result(entry))))
+            results.append(self.hydrate(entry, handler, cast(entry)))
 
         return results
 
@@ -108,27 +467,45 @@ class InsertQuery(BaseQuery):
         super(InsertQuery, self).__init__(model, 'POST')
 
     def parse_insert(self):
-        pairs = {}
-        for k, v in six.iteritems(self.insert_query):
-            field = self.model._meta.get_field_by_name(k)
+        return self.model._meta.encode(self.insert_query)
 
-            if field.required or v is not None:
-                pairs[field.api_name] = field.api_value(v)
+    def get_url(self):
+        return self.parse_url(self.model._meta.url, self.insert_query)
 
-        return pairs
+    def get_headers(self, idempotency_key=None):
+        # the same key is sent on every retry so MangoPay creates the resource once
+        return {IDEMPOTENCY_HEADER: idempotency_key or str(uuid.uuid4())}
 
-    def execute(self, handler=None):
-        handler = handler or self.handler
+    def execute(self, handler=None, idempotency_key=None, deadline=None):
+        with deadline_context(deadline):
+            handler = handler or self.handler
+
+            data = self.parse_insert()
+
+            url = self.get_url()
+
+            result, data = handler.request(self.method,
+                                           url,
+                                           data=data,
+                                           headers=self.get_headers(idempotency_key),
+                                           endpoint=self.get_endpoint())
+
+            return self.parse_insert_result(result, data, handler)
 
-        data = self.parse_insert()
+    def parse_insert_result(self, result, data, handler):
+        with self.measure_hydrate(result):
+            values = dict(self.parse_result(data))
 
-        url = self.parse_url(self.model._meta.url, self.insert_query)
+        cache = getattr(handler, 'cache', None)
 
-        result, data = handler.request(self.method,
-                                       url,
-                                       data=data)
+        if cache is not None and values.get(self.model._meta.pk_name) is not None:
+            cache.invalidate(self.model, values[self.model._meta.pk_name])
 
-        return dict(self.parse_result(data))
+        return values
+
+    def aexecute(self, handler=None, idempotency_key=None, deadline=None):
+        from .aio import insert_execute
+        return insert_execute(self, handler=handler, idempotency_key=idempotency_key, deadline=deadline)
 
 
 class UpdateQuery(BaseQuery):
@@ -140,25 +517,39 @@ class UpdateQuery(BaseQuery):
         super(UpdateQuery, self).__init__(model, 'PUT')
 
     def parse_update(self):
-        pairs = {}
-        for k, v in six.iteritems(self.update_query):
-            field = self.model._meta.get_field_by_name(k)
+        return self.model._meta.encode(self.update_query)
 
-            if field.required or v is not None:
-                pairs[field.api_name] = field.api_value(v)
+    def get_url(self):
+        meta_url = self.parse_url(self.model._meta.url, self.update_query)
+        return '%s/%d' % (meta_url, self.reference)
 
-        return pairs
+    def get_endpoint(self, model=None):
+        return '%s/%%(id)s' % super(UpdateQuery, self).get_endpoint(model)
 
-    def execute(self, handler=None):
-        handler = handler or self.handler
+    def execute(self, handler=None, deadline=None):
+        with deadline_context(deadline):
+            handler = handler or self.handler
 
-        data = self.parse_update()
+            data = self.parse_update()
 
-        meta_url = self.parse_url(self.model._meta.url, self.update_query)
-        url = '%s/%d' % (meta_url, self.reference)
+            url = self.get_url()
+
+            result, data = handler.request(self.method,
+                                           url,
+                                           data=data,
+                                           endpoint=self.get_endpoint())
+
+            return self.parse_update_result(result, data, handler)
+
+    def parse_update_result(self, result, data, handler):
+        cache = getattr(handler, 'cache', None)
+
+        if cache is not None:
+            cache.invalidate(self.model, self.reference)
 
-        result, data = handler.request(self.method,
-                                       url,
-                                       data=data)
+        with self.measure_hydrate(result):
+            return self.parse_result(data)
 
-        return self.parse_result(data)
+    def aexecute(self, handler=None, deadline=None):
+        from .aio import update_execute
+        return update_execute(self, handler=handler, deadline=deadline)
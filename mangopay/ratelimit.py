@@ -0,0 +1,194 @@
+import struct
+import threading
+import time
+
+from contextlib import contextmanager
+
+from .utils import MappedFile
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket refilled at ``rate`` tokens per second up to
+    ``capacity``. ``reserve`` takes tokens immediately, letting the balance go
+    negative, and returns how long the caller must wait before using them, so
+    concurrent callers are queued fairly instead of polling.
+    """
+
+    def __init__(self, rate=None, capacity=10):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.time()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            yield self
+
+    def _refill(self, state, now):
+        if state.rate:
+            state.tokens = min(state.capacity, state.tokens + (now - state.updated_at) * state.rate)
+
+        state.updated_at = now
+
+    def set_rate(self, rate):
+        with self.locked() as state:
+            self._refill(state, time.time())
+            state.rate = rate
+
+    def pause(self, until):
+        with self.locked() as state:
+            state.paused_until = max(state.paused_until, until)
+
+    def reserve(self, tokens=1):
+        with self.locked() as state:
+            now = time.time()
+            self._refill(state, now)
+
+            delay = max(0, state.paused_until - now)
+
+            if not state.rate:
+                return delay
+
+            state.tokens -= tokens
+
+            if state.tokens < 0:
+                delay = max(delay, -state.tokens / state.rate)
+
+            return delay
+
+    def acquire(self, tokens=1):
+        delay = self.reserve(tokens)
+
+        if delay > 0:
+            time.sleep(delay)
+
+        return delay
+
+
+class BucketState(object):
+    __slots__ = ('tokens', 'updated_at', 'rate', 'capacity', 'paused_until')
+
+    def __init__(self, tokens, updated_at, rate, capacity, paused_until):
+        self.tokens = tokens
+        self.updated_at = updated_at
+        self.rate = rate
+        self.capacity = capacity
+        self.paused_until = paused_until
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A ``TokenBucket`` whose state lives in a memory-mapped file, so every
+    process on the host opening the same ``path`` draws from one budget.
+    Updates are serialized with an exclusive file lock and the bucket keeps
+    working in processes forked after it was created. The first process to
+    create the file sets the capacity.
+    """
+
+    layout = struct.Struct('<8s5d')
+    magic = b'MPTB0001'
+
+    def __init__(self, path, rate=None, capacity=10):
+        self.file = MappedFile(path, self.layout.size)
+
+        with self.file.lock() as buf:
+            if self.layout.unpack_from(buf, 0)[0] != self.magic:
+                self.layout.pack_into(buf, 0, self.magic, capacity, time.time(), rate or 0, capacity, 0)
+
+    @contextmanager
+    def locked(self):
+        with self.file.lock() as buf:
+            values = self.layout.unpack_from(buf, 0)[1:]
+            state = BucketState(*values)
+            state.rate = state.rate or None
+
+            yield state
+
+            self.layout.pack_into(buf, 0, self.magic, state.tokens, state.updated_at,
+                                  state.rate or 0, state.capacity, state.paused_until)
+
+    @property
+    def rate(self):
+        with self.locked() as state:
+            return state.rate
+
+    @property
+    def tokens(self):
+        with self.locked() as state:
+            return state.tokens
+
+
+def parse_header_list(value):
+    if not value:
+        return []
+
+    try:
+        return [float(item) for item in value.split(',')]
+    except ValueError:
+        return []
+
+
+class RateLimiter(object):
+    """
+    Paces outgoing calls to stay under the MangoPay quota.
+
+    MangoPay returns, for each of its rate limit windows, the remaining calls
+    (``X-RateLimit-Remaining``) and the time the window resets
+    (``X-RateLimit-Reset``) as comma separated lists. After every response the
+    bucket rate is set to the slowest sustainable pace across windows, scaled
+    by ``safety_factor``; an exhausted window pauses calls until it resets.
+    ``rate`` is the pace used until the first response is seen (``None`` means
+    unlimited).
+
+    Pass a ``SharedTokenBucket`` as ``bucket`` to share one budget between
+    all the processes of a host using the same client id.
+    """
+
+    remaining_header = 'X-RateLimit-Remaining'
+    reset_header = 'X-RateLimit-Reset'
+
+    def __init__(self, rate=None, burst=10, safety_factor=0.9, bucket=None):
+        self.bucket = bucket or TokenBucket(rate, burst)
+        self.safety_factor = safety_factor
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def reserve(self):
+        return self.bucket.reserve()
+
+    def acquire(self):
+        return self.bucket.acquire()
+
+    def get_reset_time(self, value, now):
+        # epoch timestamps, or seconds until the reset for relative values
+        if value < 1e9:
+            return now + value
+
+        return value
+
+    def update(self, headers):
+        remaining = parse_header_list(headers.get(self.remaining_header))
+        resets = parse_header_list(headers.get(self.reset_header))
+
+        if not remaining or len(remaining) != len(resets):
+            return
+
+        now = time.time()
+        rates = []
+
+        for calls, reset in zip(remaining, resets):
+            reset = self.get_reset_time(reset, now)
+
+            if calls <= 0:
+                self.bucket.pause(reset)
+            else:
+                rates.append(calls / max(reset - now, 1.0))
+
+        if rates:
+            self.bucket.set_rate(min(rates) * self.safety_factor)
@@ -0,0 +1,83 @@
+import email.utils
+import random
+import time
+
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+
+class RetryPolicy(object):
+    """
+    Decides whether a failed call is retried and how long to wait first.
+
+    Only idempotent methods are retried, plus any request carrying an
+    ``Idempotency-Key`` header. Delays grow exponentially from
+    ``backoff_factor`` up to ``max_backoff`` with full jitter, unless the
+    response carries a ``Retry-After`` header, which is honoured as long as
+    it does not exceed ``max_backoff``.
+    """
+
+    def __init__(self, total=3, backoff_factor=0.5, max_backoff=30, jitter=True,
+                 methods=('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'),
+                 status_forcelist=(429, 500, 502, 503, 504),
+                 respect_retry_after=True):
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.methods = frozenset(method.upper() for method in methods)
+        self.status_forcelist = frozenset(status_forcelist)
+        self.respect_retry_after = respect_retry_after
+
+    def is_retryable(self, method, headers=None):
+        return method.upper() in self.methods or IDEMPOTENCY_HEADER in (headers or {})
+
+    def get_backoff(self, attempt):
+        backoff = min(self.max_backoff, self.backoff_factor * (2 ** attempt))
+
+        if self.jitter:
+            return random.uniform(0, backoff)
+
+        return backoff
+
+    def get_retry_after(self, result):
+        value = result.headers.get('Retry-After')
+
+        if not value:
+            return None
+
+        try:
+            return max(0, float(value))
+        except ValueError:
+            date = email.utils.parsedate_tz(value)
+
+            if date is None:
+                return None
+
+            return max(0, email.utils.mktime_tz(date) - time.time())
+
+    def get_retry_delay(self, method, headers, attempt, result=None):
+        """
+        Returns the number of seconds to wait before the next attempt, or
+        ``None`` when the call must not be retried. ``result`` is ``None``
+        when the attempt failed with a connection error.
+        """
+        if attempt >= self.total or not self.is_retryable(method, headers):
+            return None
+
+        if result is None:
+            return self.get_backoff(attempt)
+
+        if result.status_code not in self.status_forcelist:
+            return None
+
+        if self.respect_retry_after:
+            retry_after = self.get_retry_after(result)
+
+            if retry_after is not None:
+                if retry_after > self.max_backoff:
+                    return None
+
+                return retry_after
+
+        return self.get_backoff(attempt)
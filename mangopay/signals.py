@@ -9,6 +9,10 @@ request_started = signals.signal('request_started')
 
 request_error = signals.signal('request_error')
 
+request_retried = signals.signal('request_retried')
+
+circuit_state_changed = signals.signal('circuit_state_changed')
+
 pre_save = signals.signal('pre_save')
 
 post_save = signals.signal('pre_save')
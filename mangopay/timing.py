@@ -0,0 +1,162 @@
+import functools
+import threading
+import time
+
+from contextlib import contextmanager
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+PHASES = ('serialize', 'connect', 'ttfb', 'download', 'decode', 'hydrate')
+
+_local = threading.local()
+
+
+class RequestTiming(object):
+    """
+    Seconds spent in each phase of a call:
+
+    - ``serialize``: encoding the payload to JSON,
+    - ``connect``: getting a connection from the pool, opening it if needed,
+    - ``ttfb``: sending the request until the response headers arrive,
+    - ``download``: reading the response body,
+    - ``decode``: decoding the JSON body,
+    - ``hydrate``: building the model instances from it.
+
+    A phase is ``None`` when it did not happen or could not be measured;
+    ``connect`` is only measured on the sessions created by ``APIRequest``
+    (elsewhere it is part of ``ttfb``). Network phases are the ones of the
+    last attempt. ``request_finished`` receives the record before the query
+    fills in ``hydrate``.
+    """
+
+    __slots__ = PHASES
+
+    def __init__(self, **phases):
+        for phase in PHASES:
+            setattr(self, phase, phases.get(phase))
+
+    def add(self, phase, seconds):
+        setattr(self, phase, (getattr(self, phase) or 0) + seconds)
+
+    def copy(self):
+        return RequestTiming(**self.as_dict())
+
+    @property
+    def total(self):
+        return sum(getattr(self, phase) or 0 for phase in PHASES)
+
+    def as_dict(self):
+        return dict((phase, getattr(self, phase)) for phase in PHASES)
+
+    def __repr__(self):
+        return '<RequestTiming: %s>' % ' '.join('%s=%2.3f' % (phase, getattr(self, phase))
+                                                for phase in PHASES if getattr(self, phase) is not None)
+
+
+@contextmanager
+def measure(timing, phase):
+    """
+    Adds the time spent in the block to ``phase`` of ``timing``, if any.
+    """
+    ts = time.time()
+
+    try:
+        yield
+    finally:
+        if timing is not None:
+            timing.add(phase, time.time() - ts)
+
+
+@contextmanager
+def recording(timing):
+    """
+    Lets the connection pools of the current thread report to ``timing``.
+    """
+    previous, _local.timing = getattr(_local, 'timing', None), timing
+
+    try:
+        yield timing
+    finally:
+        _local.timing = previous
+
+
+def _measure_connect():
+    return measure(getattr(_local, 'timing', None), 'connect')
+
+
+class TimingHTTPConnection(HTTPConnection):
+    def connect(self):
+        with _measure_connect():
+            return super(TimingHTTPConnection, self).connect()
+
+
+class TimingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        with _measure_connect():
+            return super(TimingHTTPSConnection, self).connect()
+
+
+class IdleTimeoutMixin(object):
+    """
+    Closes the pooled connections left idle for more than
+    ``keep_alive_timeout`` seconds when they are taken out of the pool; a
+    closed connection opens again on its next request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.keep_alive_timeout = kwargs.pop('keep_alive_timeout', None)
+
+        super(IdleTimeoutMixin, self).__init__(*args, **kwargs)
+
+    def _get_conn(self, *args, **kwargs):
+        with _measure_connect():
+            conn = super(IdleTimeoutMixin, self)._get_conn(*args, **kwargs)
+
+        idle_since = getattr(conn, 'idle_since', None)
+
+        if self.keep_alive_timeout is not None and idle_since is not None:
+            if time.time() - idle_since > self.keep_alive_timeout:
+                conn.close()
+
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.idle_since = time.time()
+
+        return super(IdleTimeoutMixin, self)._put_conn(conn)
+
+
+class TimingHTTPConnectionPool(IdleTimeoutMixin, HTTPConnectionPool):
+    ConnectionCls = TimingHTTPConnection
+
+
+class TimingHTTPSConnectionPool(IdleTimeoutMixin, HTTPSConnectionPool):
+    ConnectionCls = TimingHTTPSConnection
+
+
+class TimingAdapter(HTTPAdapter):
+    """
+    An ``HTTPAdapter`` whose pools report how long getting a connection took
+    and drop the connections idle for more than ``keep_alive_timeout``
+    seconds.
+    """
+
+    __attrs__ = HTTPAdapter.__attrs__ + ['keep_alive_timeout']
+
+    def __init__(self, keep_alive_timeout=None, **kwargs):
+        self.keep_alive_timeout = keep_alive_timeout
+
+        super(TimingAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimingAdapter, self).init_poolmanager(*args, **kwargs)
+
+        # the pool manager only passes the options it knows of to the pools
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': functools.partial(TimingHTTPConnectionPool, keep_alive_timeout=self.keep_alive_timeout),
+            'https': functools.partial(TimingHTTPSConnectionPool, keep_alive_timeout=self.keep_alive_timeout),
+        }
@@ -0,0 +1,129 @@
+import random
+import time
+
+from contextlib import contextmanager
+
+from .utils import ContextLocal
+
+
+_span = ContextLocal('mangopay_span')
+
+
+def get_current_span():
+    return _span.get()
+
+
+class Span(object):
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent is not None else '%032x' % random.getrandbits(128)
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start_time = time.time()
+        self.end_time = None
+
+    @property
+    def parent_id(self):
+        return self.parent.span_id if self.parent is not None else None
+
+    @property
+    def duration(self):
+        if self.end_time is None:
+            return None
+
+        return self.end_time - self.start_time
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        self.error = error
+        self.set_attribute('error', True)
+        self.set_attribute('error.type', type(error).__name__)
+
+        code = getattr(error, 'code', None)
+
+        if code is not None:
+            self.set_attribute('http.status_code', code)
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def __repr__(self):
+        return '<Span %s: %s>' % (self.name, self.span_id)
+
+
+class NoopSpan(object):
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, error):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer(object):
+    """
+    Opens spans around model operations and HTTP calls
+    (``APIRequest(tracer=tracer)``) and hands each finished span to
+    ``exporter``, so they can be forwarded to a tracing backend.
+
+    The current span is kept in a context variable: spans opened while
+    another one is running become its children, within a thread or an
+    asyncio task. Batches, ``select_related`` and hedged calls carry it to
+    their worker threads.
+    """
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+
+    @contextmanager
+    def start_span(self, name, attributes=None):
+        span = Span(name, get_current_span(), attributes)
+        token = _span.set(span)
+
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            span.finish()
+            _span.reset(token)
+            self.export(span)
+
+    def export(self, span):
+        if self.exporter is not None:
+            self.exporter(span)
+
+
+@contextmanager
+def trace(tracer, name, attributes=None):
+    """
+    Runs the block in a span of ``tracer``, or in a span recording nothing
+    when ``tracer`` is ``None``.
+    """
+    if tracer is None:
+        yield NOOP_SPAN
+        return
+
+    with tracer.start_span(name, attributes) as span:
+        yield span
+
+
+@contextmanager
+def use_span(span):
+    """
+    Makes ``span``, captured in another thread, the parent of the spans
+    opened in the block.
+    """
+    token = _span.set(span)
+
+    try:
+        yield span
+    finally:
+        _span.reset(token)
@@ -5,13 +5,28 @@ import datetime
 import decimal
 import copy
 import inspect
+import mmap
+import os
 import six
 import sys
+import threading
 
+from concurrent.futures import Future
+from contextlib import contextmanager
 from functools import wraps
 from .exceptions import CurrencyMismatch
 from .compat import python_2_unicode_compatible
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
 if six.PY3:
     from urllib import request
     orig = request.URLopener.open_https
@@ -562,3 +577,137 @@ def truncatechars(value, length=255):
         return (value[:length] + '...') if len(value) > length else value
 
     return value
+
+
+class MappedFile(object):
+    """
+    A fixed size file mapped in memory and shared by every process opening
+    the same path. ``lock`` gives exclusive access across threads and
+    processes; the file is reopened after a fork so parent and child do not
+    share the same lock.
+    """
+
+    def __init__(self, path, size):
+        if fcntl is None:
+            raise RuntimeError('MappedFile requires a POSIX platform')
+
+        self.path = path
+        self.size = size
+        self._pid = None
+        self._open()
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size < self.size:
+                os.ftruncate(fd, self.size)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+            self.mmap = mmap.mmap(fd, self.size)
+        except Exception:
+            os.close(fd)
+            raise
+
+        self.fd = fd
+        self._pid = os.getpid()
+        self._thread_lock = threading.Lock()
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
+
+    @contextmanager
+    def lock(self):
+        if self._pid != os.getpid():
+            # the descriptors inherited from the parent are left for it to close
+            self._open()
+
+        with self._thread_lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield self.mmap
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class SingleFlight(object):
+    """
+    Runs a function once per key among concurrent callers: a thread asking
+    for a key already in flight waits for that call and gets its result, or
+    its exception, instead of running it again.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, func, timeout=None):
+        """
+        Returns the result of ``func`` and whether it was shared with the
+        caller which ran it. Callers waiting for another one give up after
+        ``timeout`` seconds with ``concurrent.futures.TimeoutError``.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            owner = future is None
+
+            if owner:
+                future = self._calls[key] = Future()
+
+        if not owner:
+            return future.result(timeout), True
+
+        try:
+            result = func()
+        except Exception as e:
+            self._finish(key)
+            future.set_exception(e)
+            raise
+
+        self._finish(key)
+        future.set_result(result)
+
+        return result, False
+
+    def _finish(self, key):
+        with self._lock:
+            del self._calls[key]
+
+
+class ContextLocal(object):
+    """
+    A value local to the current asyncio task or thread, held in a context
+    variable or, without ``contextvars``, in a thread local. ``set`` returns
+    the token ``reset`` takes to restore the previous value.
+    """
+
+    def __init__(self, name):
+        if contextvars is not None:
+            self._var = contextvars.ContextVar(name, default=None)
+        else:
+            self._var = None
+            self._local = threading.local()
+
+    def get(self):
+        if self._var is not None:
+            return self._var.get()
+
+        return getattr(self._local, 'value', None)
+
+    def set(self, value):
+        if self._var is not None:
+            return self._var.set(value)
+
+        previous, self._local.value = self.get(), value
+        return previous
+
+    def reset(self, token):
+        if self._var is not None:
+            self._var.reset(token)
+        else:
+            self._local.value = token
@@ -27,12 +27,13 @@ setup(
     ],
     keywords='mangopay api development',
     packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
-    install_requires=['requests', 'simplejson', 'blinker', 'six'],
+    install_requires=['requests', 'simplejson', 'blinker', 'six', 'futures; python_version < "3"'],
     extras_require={
         'dev': ['responses', 'nose', 'coverage', 'httplib2',
                 'pyopenssl', 'ndg-httpsclient', 'pyasn1', 'exam'],
         'test': ['responses', 'nose', 'coverage', 'httplib2',
                  'pyopenssl', 'ndg-httpsclient', 'pyasn1', 'exam'],
+        'async': ['aiohttp'],
     },
     entry_points={
         'console_scripts': [
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import time
+import unittest
+
+from http.server import BaseHTTPRequestHandler
+from unittest import mock
+
+from mangopay.aio import AsyncAPIRequest, aiohttp
+from mangopay.cache import ResponseCache
+from mangopay.exceptions import APIError, DeadlineExceeded, RequestTimeout
+from mangopay.tracing import Tracer
+
+from .helpers import LocalServer, get_handler
+from .resources import NaturalUser, User, Wallet
+
+
+class FakeResponse(object):
+    def __init__(self, status, body):
+        self.status = status
+        self.headers = {'Content-Type': 'application/json'}
+        self.body = json.dumps(body).encode('utf-8')
+
+    async def read(self):
+        return self.body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class FakeSession(object):
+    def __init__(self, routes):
+        self.routes = routes
+        self.calls = []
+
+    def request(self, method, url, data=None, headers=None, **options):
+        self.calls.append((method, url, data, headers))
+        self.options = options
+        status, body = self.routes[(method, url)]
+        return FakeResponse(status, body)
+
+
+WALLET = {
+    "Owners": ["1169419"],
+    "Description": "Wallet of Victor Hugo",
+    "Balance": {"Currency": "EUR", "Amount": 0},
+    "Currency": "EUR",
+    "Id": "1169421",
+    "Tag": "My custom tag",
+    "CreationDate": 1383323329
+}
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+class AsyncAPIRequestTest(unittest.TestCase):
+    base_url = 'https://api.sandbox.mangopay.com/v2/chouette'
+
+    def get_handler(self, routes, **kwargs):
+        return get_handler(AsyncAPIRequest, session=FakeSession(routes), **kwargs)
+
+    def setUp(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def tearDown(self):
+        asyncio.get_event_loop().close()
+
+    def test_get(self):
+        handler = self.get_handler({
+            ('GET', self.base_url + '/wallets/1169421'): (200, WALLET),
+        })
+
+        wallet = run(Wallet.aget(1169421, handler=handler))
+
+        self.assertIsInstance(wallet, Wallet)
+        self.assertEqual(wallet.get_pk(), 1169421)
+        self.assertEqual(wallet.currency, 'EUR')
+        self.assertIs(wallet.handler, handler)
+
+    def test_concurrent_gets_are_coalesced(self):
+        handler = self.get_handler({
+            ('GET', self.base_url + '/wallets/1169421'): (200, WALLET),
+        }, single_flight=True)
+
+        async def get_many():
+            return await asyncio.gather(*[handler.request('GET', '/wallets/1169421') for i in range(5)])
+
+        results = run(get_many())
+
+        self.assertEqual(len(handler.session.calls), 1)
+        self.assertEqual(len(set(id(data) for result, data in results)), 5)
+
+    def test_select_related(self):
+        handler = self.get_handler({
+            ('GET', self.base_url + '/wallets'): (200, [dict(WALLET, Id=str(i)) for i in range(1, 6)]),
+            ('GET', self.base_url + '/users/1169419'): (200, {"Id": "1169419", "PersonType": "NATURAL"}),
+        })
+
+        wallets = run(Wallet.select().prefetch_related('owners').aall(handler=handler))
+
+        self.assertEqual(len(handler.session.calls), 2)
+        self.assertEqual([owner.get_pk() for owner in wallets[0].owners], [1169419])
+
+    def test_get_refreshes_stale_entries_in_the_background(self):
+        handler = self.get_handler({
+            ('GET', self.base_url + '/wallets/1169421'): (200, WALLET),
+        }, cache=ResponseCache(ttl=0.01, stale_ttl=60))
+
+        run(Wallet.aget(1169421, handler=handler))
+        time.sleep(0.02)
+
+        async def get_twice():
+            first = await Wallet.aget(1169421, handler=handler)
+            second = await Wallet.aget(1169421, handler=handler)
+            await asyncio.sleep(0)
+            return first, second
+
+        first, second = run(get_twice())
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(handler.session.calls), 2)
+        self.assertEqual(handler.cache.stale_hits, 2)
+        self.assertFalse(handler.cache.lookup(Wallet, 1169421)[1])
+
+    def test_get_does_not_exist(self):
+        handler = self.get_handler({
+            ('GET', self.base_url + '/wallets/1'): (404, {'errors': []}),
+        })
+
+        with self.assertRaises(Wallet.DoesNotExist):
+            run(Wallet.aget(1, handler=handler))
+
+    def test_all_casts_results(self):
+        handler = self.get_handler({
+            ('GET', self.base_url + '/users?per_page=2'): (200, [
+                {"Id": "1169419", "PersonType": "NATURAL", "Email": "victor@hugo.com"},
+            ]),
+        })
+
+        users = run(User.aall(handler=handler, per_page=2))
+
+        self.assertEqual(len(users), 1)
+        self.assertIsInstance(users[0], NaturalUser)
+
+    def test_create_then_update(self):
+        handler = self.get_handler({
+            ('POST', self.base_url + '/wallets'): (200, WALLET),
+            ('PUT', self.base_url + '/wallets/1169421'): (200, dict(WALLET, Tag='updated')),
+        })
+
+        wallet = run(Wallet.acreate(handler=handler,
+                                    owners=[NaturalUser(id=1169419)],
+                                    description='Wallet of Victor Hugo',
+                                    currency='EUR'))
+        self.assertEqual(wallet.get_pk(), 1169421)
+
+        wallet.tag = 'updated'
+        run(wallet.asave(handler))
+
+        method, url, data, headers = handler.session.calls[-1]
+        self.assertEqual(method, 'PUT')
+        self.assertEqual(json.loads(data)['Tag'], 'updated')
+        self.assertEqual(wallet.tag, 'updated')
+
+    def test_expired_deadlines_send_nothing(self):
+        handler = self.get_handler({
+            ('GET', self.base_url + '/wallets/1169421'): (200, WALLET),
+        })
+
+        with self.assertRaises(DeadlineExceeded):
+            run(Wallet.aget(1169421, handler=handler, deadline=0))
+
+        self.assertEqual(handler.session.calls, [])
+
+    def test_spans_nest_across_tasks(self):
+        spans = []
+        handler = self.get_handler({
+            ('GET', self.base_url + '/wallets'): (200, [dict(WALLET, Id=str(i)) for i in range(1, 3)]),
+            ('GET', self.base_url + '/users/1169419'): (200, {"Id": "1169419", "PersonType": "NATURAL"}),
+        }, tracer=Tracer(exporter=spans.append))
+
+        run(Wallet.select().prefetch_related('owners').aall(handler=handler))
+
+        query = [span for span in spans if span.name == 'mangopay.all'][0]
+        get = [span for span in spans if span.name == 'mangopay.get'][0]
+
+        self.assertIs(get.parent, query)
+        self.assertEqual([span.parent for span in spans if span.name == 'mangopay.request'], [query, get])
+
+    def test_error_mapping(self):
+        handler = self.get_handler({
+            ('GET', self.base_url + '/wallets/1'): (500, {'Message': 'boom'}),
+        })
+
+        with self.assertRaises(APIError) as cm:
+            run(Wallet.aget(1, handler=handler))
+
+        self.assertEqual(cm.exception.code, 500)
+        self.assertEqual(cm.exception.content, {'Message': 'boom'})
+
+    def test_missing_aiohttp_raises_an_import_error(self):
+        handler = get_handler(AsyncAPIRequest, read_timeout=5)
+
+        with mock.patch('mangopay.aio.aiohttp', None):
+            with self.assertRaises(ImportError):
+                run(handler.request('GET', '/wallets/1'))
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_timeouts_are_passed_to_the_session(self):
+        handler = self.get_handler({
+            ('GET', self.base_url + '/wallets/1'): (200, WALLET),
+        }, connect_timeout=2, read_timeout=5)
+
+        run(Wallet.aget(1, handler=handler))
+
+        timeout = handler.session.options['timeout']
+
+        self.assertEqual((timeout.sock_connect, timeout.sock_read), (2, 5))
+
+    def test_handler_is_required(self):
+        with self.assertRaises(TypeError):
+            run(Wallet.aget(1))
+
+    def test_sync_handler_is_rejected(self):
+        from .resources import handler
+
+        with self.assertRaises(TypeError):
+            run(Wallet.aget(1, handler=handler))
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class AiohttpTest(unittest.TestCase):
+    """
+    Runs the handler on a real aiohttp session against a local server.
+    """
+
+    def setUp(self):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                body = json.dumps(WALLET).encode('utf-8')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+
+                if self.path.endswith('/stalled'):
+                    # the headers arrive, the body never does
+                    self.wfile.write(body[:5])
+                    self.wfile.flush()
+                    time.sleep(1)
+                else:
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = LocalServer(Handler)
+
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def tearDown(self):
+        asyncio.get_event_loop().close()
+
+        self.server.stop()
+
+    def get_handler(self, **kwargs):
+        return get_handler(AsyncAPIRequest, api_sandbox_url=self.server.api_url, **kwargs)
+
+    def test_get(self):
+        async def get():
+            async with self.get_handler(pool_maxsize=2, connect_timeout=2, read_timeout=2) as handler:
+                return await Wallet.aget(1169421, handler=handler)
+
+        wallet = run(get())
+
+        self.assertEqual(wallet.get_pk(), 1169421)
+        self.assertEqual(wallet.owners_ids, ['1169419'])
+
+    def test_stalled_body_raises_a_timeout(self):
+        async def get():
+            async with self.get_handler(read_timeout=0.2) as handler:
+                return await handler.request('GET', '/wallets/stalled')
+
+        with self.assertRaises(RequestTimeout) as cm:
+            run(get())
+
+        self.assertNotIsInstance(cm.exception, DeadlineExceeded)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from six.moves import BaseHTTPServer, socketserver
+
+from mangopay.api import APIRequest
+
+from . import settings
+
+
+def get_handler(handler_class=APIRequest, **kwargs):
+    kwargs.setdefault('sandbox', True)
+
+    return handler_class(client_id=settings.MANGOPAY_CLIENT_ID,
+                         passphrase=settings.MANGOPAY_PASSPHRASE,
+                         **kwargs)
+
+
+class LocalServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, request_handler):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), request_handler)
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def api_url(self):
+        return 'http://127.0.0.1:%d/v2/' % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
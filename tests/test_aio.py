@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+import six
+
+# the asynchronous handler needs python 3, its tests cannot even be parsed by python 2
+if six.PY3:
+    from .aio_cases import *  # noqa
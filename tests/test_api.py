@@ -0,0 +1,593 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+import unittest
+
+import requests
+import responses
+
+from six.moves import BaseHTTPServer
+
+from mangopay.cache import MemoryBackend, ResponseCache
+from mangopay.deadline import deadline_context
+from mangopay.exceptions import APIError, DeadlineExceeded, RequestTimeout
+from mangopay.hedge import HedgePolicy
+from mangopay.retry import RetryPolicy
+from mangopay.signals import request_finished, request_started
+from mangopay.timing import RequestTiming
+
+from .helpers import LocalServer, get_handler
+from .resources import Wallet
+
+
+class APIRequestTest(unittest.TestCase):
+    def test_handlers_own_their_session(self):
+        first, second = get_handler(), get_handler()
+
+        self.assertIsInstance(first.requests_session, requests.Session)
+        self.assertIsNot(first.requests_session, second.requests_session)
+
+    def test_pool_configuration(self):
+        handler = get_handler(pool_connections=4, pool_maxsize=64, pool_block=True)
+
+        adapter = handler.requests_session.get_adapter('https://api.sandbox.mangopay.com/v2/')
+
+        self.assertEqual(adapter._pool_connections, 4)
+        self.assertEqual(adapter._pool_maxsize, 64)
+        self.assertTrue(adapter._pool_block)
+
+    def test_custom_session(self):
+        session = requests.Session()
+
+        self.assertIs(get_handler(requests_session=session).requests_session, session)
+
+
+class IdleConnectionTest(unittest.TestCase):
+    """
+    A real keep-alive server, counting the connections it accepts.
+    """
+
+    def setUp(self):
+        clients = self.clients = set()
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                clients.add(self.client_address)
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = LocalServer(Handler)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def get_handler(self, **kwargs):
+        return get_handler(api_sandbox_url=self.server.api_url, **kwargs)
+
+    def request_twice(self, handler):
+        handler.request('GET', '/wallets/1')
+        time.sleep(0.1)
+        handler.request('GET', '/wallets/1')
+
+    def test_connections_are_reused(self):
+        self.request_twice(self.get_handler(keep_alive_timeout=30))
+
+        self.assertEqual(len(self.clients), 1)
+
+    def test_idle_connections_are_dropped(self):
+        self.request_twice(self.get_handler(keep_alive_timeout=0.05))
+
+        self.assertEqual(len(self.clients), 2)
+
+
+class RetryPolicyTest(unittest.TestCase):
+    base_url = 'https://api.sandbox.mangopay.com/v2/chouette'
+
+    def get_handler(self, **kwargs):
+        return get_handler(retry_policy=RetryPolicy(backoff_factor=0, **kwargs))
+
+    @responses.activate
+    def test_get_is_retried_on_server_error(self):
+        url = self.base_url + '/wallets/1169421'
+        responses.add(responses.GET, url, body='{}', status=503)
+        responses.add(responses.GET, url, body='{"Id": "1169421"}', status=200)
+
+        wallet = Wallet.get(1169421, handler=self.get_handler())
+
+        self.assertEqual(wallet.get_pk(), 1169421)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_gives_up_after_total_retries(self):
+        url = self.base_url + '/wallets/1169421'
+        responses.add(responses.GET, url, body='{}', status=503)
+
+        with self.assertRaises(APIError) as cm:
+            Wallet.get(1169421, handler=self.get_handler(total=2))
+
+        self.assertEqual(cm.exception.code, 503)
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_insert_is_retried_with_the_same_idempotency_key(self):
+        url = self.base_url + '/wallets'
+        responses.add(responses.POST, url, body='{}', status=502)
+        responses.add(responses.POST, url, body='{"Id": "1169421"}', status=200)
+
+        Wallet.insert(description='Wallet', currency='EUR').execute(handler=self.get_handler())
+
+        keys = [call.request.headers['Idempotency-Key'] for call in responses.calls]
+        self.assertEqual(len(keys), 2)
+        self.assertEqual(keys[0], keys[1])
+
+    @responses.activate
+    def test_post_without_idempotency_key_is_not_retried(self):
+        url = self.base_url + '/wallets'
+        responses.add(responses.POST, url, body='{}', status=502)
+
+        with self.assertRaises(APIError):
+            self.get_handler().request('POST', '/wallets', data={})
+
+        self.assertEqual(len(responses.calls), 1)
+
+    def test_retry_after(self):
+        policy = RetryPolicy(max_backoff=10)
+        result = requests.Response()
+        result.status_code = 429
+
+        result.headers['Retry-After'] = '3'
+        self.assertEqual(policy.get_retry_delay('GET', {}, 0, result), 3)
+
+        result.headers['Retry-After'] = '60'
+        self.assertIsNone(policy.get_retry_delay('GET', {}, 0, result))
+
+    def test_backoff_is_capped(self):
+        policy = RetryPolicy(total=10, backoff_factor=1, max_backoff=4, jitter=False)
+
+        self.assertEqual([policy.get_backoff(attempt) for attempt in range(5)], [1, 2, 4, 4, 4])
+        self.assertIsNone(policy.get_retry_delay('GET', {}, 10))
+
+
+class SingleFlightTest(unittest.TestCase):
+    url = 'https://api.sandbox.mangopay.com/v2/chouette/wallets/1169421'
+
+    def get_handler(self):
+        return get_handler(single_flight=True)
+
+    def run_concurrently(self, func, count=8):
+        results, errors = [], []
+
+        def run():
+            try:
+                results.append(func())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for i in range(count)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        return results, errors
+
+    def slow_callback(self, status, body):
+        def callback(request):
+            time.sleep(0.05)
+            return status, {'Content-Type': 'application/json'}, json.dumps(body)
+
+        return callback
+
+    @responses.activate
+    def test_concurrent_gets_are_coalesced(self):
+        responses.add_callback(responses.GET, self.url,
+                               callback=self.slow_callback(200, {"Id": "1169421", "Owners": ["1169419"]}))
+
+        handler = self.get_handler()
+
+        results, errors = self.run_concurrently(lambda: handler.request('GET', '/wallets/1169421'))
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(len(results), 8)
+        self.assertEqual(len(set(id(data['Owners']) for result, data in results)), 8)
+        self.assertEqual(len(handler.in_flight), 0)
+
+    @responses.activate
+    def test_errors_are_shared(self):
+        responses.add_callback(responses.GET, self.url, callback=self.slow_callback(500, {"errors": {}}))
+
+        handler = self.get_handler()
+        results, errors = self.run_concurrently(lambda: handler.request('GET', '/wallets/1169421'))
+
+        self.assertEqual(len(errors), 8)
+        self.assertTrue(all(isinstance(error, APIError) for error in errors))
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_waiters_give_up_at_their_deadline(self):
+        started = threading.Event()
+
+        def callback(request):
+            started.set()
+            time.sleep(0.3)
+            return 200, {'Content-Type': 'application/json'}, json.dumps({"Id": "1169421"})
+
+        responses.add_callback(responses.GET, self.url, callback=callback)
+
+        handler = self.get_handler()
+        owner = threading.Thread(target=handler.request, args=('GET', '/wallets/1169421'))
+        owner.start()
+        started.wait()
+
+        ts = time.time()
+
+        with self.assertRaises(DeadlineExceeded):
+            with deadline_context(0.05):
+                handler.request('GET', '/wallets/1169421')
+
+        self.assertLess(time.time() - ts, 0.2)
+        self.assertEqual(len(handler.in_flight), 1)
+
+        owner.join()
+
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_other_methods_are_not_coalesced(self):
+        responses.add_callback(responses.PUT, self.url, callback=self.slow_callback(200, {"Id": "1169421"}))
+
+        handler = self.get_handler()
+
+        self.run_concurrently(lambda: handler.request('PUT', '/wallets/1169421', data={'Tag': 'tag'}), count=3)
+
+        self.assertEqual(len(responses.calls), 3)
+
+
+class HedgePolicyTest(unittest.TestCase):
+    url = 'https://api.sandbox.mangopay.com/v2/chouette/wallets/1169421'
+
+    def get_handler(self, **kwargs):
+        policy = HedgePolicy(min_samples=1, **kwargs)
+        policy.record(0.01)
+
+        return get_handler(hedge_policy=policy)
+
+    def add_slow_first_response(self):
+        lock = threading.Lock()
+        calls = []
+
+        def callback(request):
+            with lock:
+                calls.append(1)
+                first = len(calls) == 1
+
+            if first:
+                time.sleep(0.3)
+
+            return 200, {'Content-Type': 'application/json'}, json.dumps({"Id": "1169421", "Tag": len(calls)})
+
+        responses.add_callback(responses.GET, self.url, callback=callback)
+
+    def wait_for_calls(self, count, timeout=1):
+        expires_at = time.time() + timeout
+
+        while len(responses.calls) < count and time.time() < expires_at:
+            time.sleep(0.01)
+
+    @responses.activate
+    def test_slow_calls_are_hedged(self):
+        self.add_slow_first_response()
+
+        handler = self.get_handler(budget=1)
+
+        ts = time.time()
+        wallet = Wallet.get(1169421, handler=handler)
+
+        self.assertLess(time.time() - ts, 0.3)
+        self.assertEqual(wallet.get_pk(), 1169421)
+        self.assertEqual(handler.hedge_policy.hedges, 1)
+
+        # let the losing request finish while the mocks are active
+        self.wait_for_calls(2)
+
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_calls_do_not_wait_for_a_hedge_worker(self):
+        responses.add_callback(responses.GET, self.url, callback=lambda request: (
+            time.sleep(0.2) or (200, {}, json.dumps({"Id": "1169421"}))))
+
+        handler = self.get_handler(budget=1, max_workers=1)
+        handler.hedge_policy.record(1)
+        handler.hedge_policy.min_delay = 1
+
+        threads = [threading.Thread(target=Wallet.get, args=(1169421, ), kwargs={'handler': handler})
+                   for i in range(4)]
+
+        ts = time.time()
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertLess(time.time() - ts, 0.5)
+        self.assertEqual(len(responses.calls), 4)
+        self.assertEqual(handler.hedge_policy.hedges, 0)
+
+    @responses.activate
+    def test_hedges_are_capped_by_the_budget(self):
+        self.add_slow_first_response()
+
+        handler = self.get_handler(budget=0)
+
+        Wallet.get(1169421, handler=handler)
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(handler.hedge_policy.hedges, 0)
+
+    def test_delay_follows_the_percentile(self):
+        policy = HedgePolicy(percentile=90, min_samples=10)
+
+        self.assertIsNone(policy.get_delay())
+
+        for latency in range(1, 101):
+            policy.record(latency / 100.0)
+
+        self.assertEqual(policy.get_delay(), 0.91)
+
+
+class DeadlineTest(unittest.TestCase):
+    url = 'https://api.sandbox.mangopay.com/v2/chouette/wallets/1169421'
+
+    def get_session(self, timeouts):
+        class Session(requests.Session):
+            def request(self, *args, **kwargs):
+                timeouts.append(kwargs.get('timeout'))
+                return super(Session, self).request(*args, **kwargs)
+
+        return Session()
+
+    @responses.activate
+    def test_timeouts_are_capped_by_the_deadline(self):
+        responses.add(responses.GET, self.url, body='{"Id": "1169421"}', status=200)
+
+        timeouts = []
+        handler = get_handler(connect_timeout=3, read_timeout=30, requests_session=self.get_session(timeouts))
+
+        Wallet.get(1169421, handler=handler)
+        Wallet.get(1169421, handler=handler, deadline=10)
+
+        self.assertEqual(timeouts[0], (3, 30))
+        self.assertEqual(timeouts[1][0], 3)
+        self.assertTrue(9 < timeouts[1][1] <= 10)
+
+    @responses.activate
+    def test_nested_deadlines_share_the_budget(self):
+        responses.add(responses.GET, self.url, body='{"Id": "1169421"}', status=200)
+
+        timeouts = []
+        handler = get_handler(requests_session=self.get_session(timeouts))
+
+        with deadline_context(2):
+            Wallet.get(1169421, handler=handler, deadline=60)
+
+        self.assertTrue(timeouts[0][1] <= 2)
+
+    @responses.activate
+    def test_timeouts_are_raised(self):
+        responses.add(responses.GET, self.url, body=requests.exceptions.ReadTimeout('read timed out'))
+
+        with self.assertRaises(RequestTimeout) as cm:
+            Wallet.get(1169421, handler=get_handler(read_timeout=1))
+
+        self.assertNotIsInstance(cm.exception, DeadlineExceeded)
+        self.assertEqual(cm.exception.url, self.url)
+
+    @responses.activate
+    def test_expired_deadlines_send_nothing(self):
+        with self.assertRaises(DeadlineExceeded):
+            Wallet.get(1169421, handler=get_handler(), deadline=0)
+
+        self.assertEqual(len(responses.calls), 0)
+
+    @responses.activate
+    def test_retries_stop_at_the_deadline(self):
+        responses.add(responses.GET, self.url, body='{}', status=503)
+
+        handler = get_handler(retry_policy=RetryPolicy(total=5, backoff_factor=10, jitter=False))
+
+        ts = time.time()
+
+        with self.assertRaises(DeadlineExceeded):
+            Wallet.get(1169421, handler=handler, deadline=5)
+
+        self.assertLess(time.time() - ts, 1)
+        self.assertEqual(len(responses.calls), 1)
+
+
+class StalledBodyTest(unittest.TestCase):
+    """
+    A real server sending the headers then stalling, the read timeout hits
+    while the body is downloaded.
+    """
+
+    def setUp(self):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', '100')
+                self.end_headers()
+                self.wfile.write(b'{"Id": ')
+                self.wfile.flush()
+                time.sleep(1)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = LocalServer(Handler)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def get_handler(self, **kwargs):
+        return get_handler(api_sandbox_url=self.server.api_url, **kwargs)
+
+    def test_stalled_body_raises_a_timeout(self):
+        with self.assertRaises(RequestTimeout) as cm:
+            self.get_handler(read_timeout=0.2).request('GET', '/wallets/1169421')
+
+        self.assertNotIsInstance(cm.exception, DeadlineExceeded)
+
+    def test_stalled_body_raises_at_the_deadline(self):
+        ts = time.time()
+
+        with self.assertRaises(DeadlineExceeded):
+            with deadline_context(0.3):
+                self.get_handler().request('GET', '/wallets/1169421')
+
+        self.assertLess(time.time() - ts, 0.8)
+
+
+class RequestTimingTest(unittest.TestCase):
+    base_url = 'https://api.sandbox.mangopay.com/v2/chouette'
+
+    def setUp(self):
+        self.handler = get_handler()
+
+    @responses.activate
+    def test_phases_are_measured(self):
+        responses.add(responses.POST, self.base_url + '/wallets', body='{"Id": "1169421"}', status=200)
+
+        timings = []
+
+        def on_finished(sender, timing, **kwargs):
+            timings.append((timing, timing.decode))
+
+        request_finished.connect(on_finished)
+
+        try:
+            query = Wallet.insert(description='Wallet', currency='EUR')
+            result, data = self.handler.request('POST', '/wallets', data=query.parse_insert())
+        finally:
+            request_finished.disconnect(on_finished)
+
+        timing = result.timing
+
+        self.assertIs(timings[0][0], timing)
+        # decoded before the signal was sent
+        self.assertEqual(timings[0][1], timing.decode)
+
+        for phase in ('serialize', 'ttfb', 'download', 'decode'):
+            self.assertGreaterEqual(getattr(timing, phase), 0)
+
+        # the mocked transport opens no connection
+        self.assertIsNone(timing.connect)
+        self.assertIsNone(timing.hydrate)
+
+    @responses.activate
+    def test_hydration_is_measured(self):
+        responses.add(responses.GET, self.base_url + '/wallets/1169421', body='{"Id": "1169421"}', status=200)
+
+        timings = []
+
+        def on_finished(sender, timing, **kwargs):
+            timings.append(timing)
+
+        request_finished.connect(on_finished)
+
+        try:
+            Wallet.get(1169421, handler=self.handler)
+        finally:
+            request_finished.disconnect(on_finished)
+
+        self.assertGreaterEqual(timings[0].hydrate, 0)
+        self.assertIsNone(timings[0].serialize)
+
+    @responses.activate
+    def test_signal_receivers_are_not_server_time(self):
+        responses.add(responses.GET, self.base_url + '/wallets/1169421', body='{"Id": "1169421"}', status=200)
+
+        def on_started(sender, **kwargs):
+            time.sleep(0.1)
+
+        request_started.connect(on_started)
+
+        try:
+            result, data = self.handler.request('GET', '/wallets/1169421')
+        finally:
+            request_started.disconnect(on_started)
+
+        self.assertLess(result.timing.ttfb, 0.1)
+
+    @responses.activate
+    def test_cache_writes_are_not_hydration(self):
+        responses.add(responses.GET, self.base_url + '/wallets/1169421', body='{"Id": "1169421"}', status=200)
+
+        class SlowBackend(MemoryBackend):
+            def set(self, key, value, ttl):
+                time.sleep(0.1)
+                super(SlowBackend, self).set(key, value, ttl)
+
+        timings = []
+
+        def on_finished(sender, timing, **kwargs):
+            timings.append(timing)
+
+        handler = get_handler(cache=ResponseCache(backend=SlowBackend()))
+
+        request_finished.connect(on_finished)
+
+        try:
+            Wallet.get(1169421, handler=handler)
+        finally:
+            request_finished.disconnect(on_finished)
+
+        self.assertLess(timings[0].hydrate, 0.1)
+
+    @responses.activate
+    def test_coalesced_callers_get_their_own_timing(self):
+        def callback(request):
+            time.sleep(0.05)
+            return 200, {}, '{"Id": "1169421"}'
+
+        responses.add_callback(responses.GET, self.base_url + '/wallets/1169421', callback=callback)
+
+        handler = get_handler(single_flight=True)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(handler.request('GET', '/wallets/1169421')[0]))
+                   for i in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(len(set(id(result.timing) for result in results)), 4)
+        self.assertEqual(set(result.timing.ttfb for result in results), set([results[0].timing.ttfb]))
+
+    def test_total(self):
+        timing = RequestTiming(ttfb=0.2, download=0.05)
+        timing.add('hydrate', 0.01)
+        timing.add('hydrate', 0.02)
+
+        self.assertAlmostEqual(timing.hydrate, 0.03)
+        self.assertAlmostEqual(timing.total, 0.28)
+        self.assertIsNone(timing.as_dict()['connect'])
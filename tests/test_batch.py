@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+import unittest
+
+import responses
+
+from mangopay import batch as batch_module
+from mangopay.batch import AdaptiveConcurrency, Batch
+from mangopay.deadline import deadline_context, get_remaining
+from mangopay.exceptions import APIError, CircuitOpenError, RequestTimeout
+from mangopay.metrics import MetricsRegistry, generate_latest
+
+from .helpers import get_handler
+from .resources import Transfer, Wallet
+from .test_identity import WALLET
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class BatchTest(unittest.TestCase):
+    base_url = 'https://api.sandbox.mangopay.com/v2/chouette'
+
+    def setUp(self):
+        self.handler = get_handler()
+
+    @responses.activate
+    def test_results_are_in_submission_order(self):
+        for i in range(1, 21):
+            responses.add(responses.GET, self.base_url + '/wallets/%d' % i,
+                          body=json.dumps(dict(WALLET, Id=str(i))), status=200, content_type='application/json')
+
+        responses.add(responses.GET, self.base_url + '/wallets/21', body='{"errors": {}}', status=500,
+                      content_type='application/json')
+
+        batch = self.handler.batch(max_workers=4)
+
+        for i in range(1, 22):
+            batch.get(Wallet, i)
+
+        results = batch.run()
+
+        self.assertEqual([result.value.get_pk() for result in results[:20]], list(range(1, 21)))
+        self.assertFalse(results[20].ok)
+        self.assertIsInstance(results[20].error, APIError)
+        self.assertEqual(len(batch), 0)
+
+    @responses.activate
+    def test_insert_and_update_queries(self):
+        responses.add(responses.POST, self.base_url + '/transfers', body=json.dumps({"Id": "1"}), status=200,
+                      content_type='application/json')
+        responses.add(responses.PUT, self.base_url + '/wallets/1169421', body=json.dumps(WALLET), status=200,
+                      content_type='application/json')
+
+        batch = self.handler.batch()
+        batch.execute(Transfer.insert(tag='transfer'))
+        batch.execute(Wallet.update(1169421, tag='updated'))
+
+        results = batch.run()
+
+        self.assertEqual(results[0].value['id'], 1)
+        self.assertEqual(results[1].value['id'], 1169421)
+
+    def test_concurrency_is_bounded(self):
+        lock = threading.Lock()
+        running, peak = [0], [0]
+
+        def call():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+
+            time.sleep(0.01)
+
+            with lock:
+                running[0] -= 1
+
+        batch = Batch(self.handler, max_workers=3)
+
+        for i in range(12):
+            batch.add(call)
+
+        batch.run()
+
+        self.assertEqual(peak[0], 3)
+
+    def test_calls_keep_the_deadline_they_were_queued_with(self):
+        batch = Batch(self.handler)
+
+        with deadline_context(10):
+            batch.add(get_remaining)
+
+        batch.add(get_remaining)
+
+        first, second = batch.run()
+
+        self.assertTrue(9 < first.value <= 10)
+        self.assertIsNone(second.value)
+
+    def test_rate_is_capped(self):
+        batch = Batch(self.handler, max_workers=8, rate=100)
+
+        for i in range(11):
+            batch.add(time.time)
+
+        results = batch.run()
+        starts = sorted(result.value for result in results)
+
+        self.assertGreaterEqual(starts[-1] - starts[0], 0.09)
+
+
+class AdaptiveConcurrencyTest(unittest.TestCase):
+    def test_limit_grows_additively(self):
+        concurrency = AdaptiveConcurrency(initial=4, max_limit=6)
+
+        for i in range(4):
+            concurrency.acquire()
+            concurrency.release(time.time())
+
+        self.assertEqual(concurrency.limit, 4)
+
+        for i in range(100):
+            concurrency.acquire()
+            concurrency.release(time.time())
+
+        self.assertEqual(concurrency.limit, 6)
+
+    def test_limit_is_cut_on_overload(self):
+        concurrency = AdaptiveConcurrency(initial=16)
+        started_at = time.time()
+
+        concurrency.acquire()
+        concurrency.acquire()
+        concurrency.release(started_at, APIError('Too many requests', code=429))
+        concurrency.release(started_at, APIError('Too many requests', code=429))
+
+        self.assertEqual(concurrency.limit, 8)
+
+        concurrency.acquire()
+        concurrency.release(time.time(), APIError('Service unavailable', code=503))
+
+        self.assertEqual(concurrency.limit, 4)
+
+        concurrency.acquire()
+        concurrency.release(time.time(), APIError('Bad request', code=400))
+
+        self.assertEqual(concurrency.limit, 4)
+
+    def test_timeouts_and_connection_errors_are_overload(self):
+        concurrency = AdaptiveConcurrency(initial=16)
+
+        concurrency.acquire()
+        concurrency.release(time.time(), RequestTimeout('ReadTimeout'))
+
+        self.assertEqual(concurrency.limit, 8)
+
+        concurrency.acquire()
+        concurrency.release(time.time(), APIError('ConnectionError: Connection refused'))
+
+        self.assertEqual(concurrency.limit, 4)
+
+    def test_failed_calls_never_raise_the_limit(self):
+        concurrency = AdaptiveConcurrency(initial=4)
+
+        for error in (CircuitOpenError('Circuit open'), APIError('Bad request', code=400), ValueError()):
+            for i in range(10):
+                concurrency.acquire()
+                concurrency.release(time.time(), error)
+
+        self.assertEqual(concurrency.limit, 4)
+
+    def test_limit_is_cut_on_latency_spikes(self):
+        concurrency = AdaptiveConcurrency(initial=8, latency_tolerance=2.0)
+
+        concurrency.acquire()
+        concurrency.release(time.time() - 0.01)
+        concurrency.acquire()
+        concurrency.release(time.time() - 0.1)
+
+        self.assertEqual(concurrency.limit, 4)
+
+    def test_lasting_latency_increases_become_the_usual_latency(self):
+        clock = FakeClock()
+        concurrency = AdaptiveConcurrency(initial=8)
+
+        def call(latency):
+            concurrency.acquire()
+            started_at = clock.now
+            clock.now += latency
+            concurrency.release(started_at)
+
+        original, batch_module.time = batch_module.time, clock
+
+        try:
+            for i in range(50):
+                call(0.05)
+
+            for i in range(500):
+                call(0.15)
+        finally:
+            batch_module.time = original
+
+        self.assertAlmostEqual(concurrency.latency, 0.15)
+        self.assertGreater(concurrency.limit, 8)
+
+    def test_limit_is_published_as_a_gauge(self):
+        metrics = MetricsRegistry()
+        handler = get_handler(metrics=metrics)
+        batch = handler.batch(concurrency=AdaptiveConcurrency(initial=4))
+
+        batch.add(lambda: None)
+        batch.run()
+
+        self.assertEqual(metrics.gauges['concurrency_limit'][1], 4)
+        self.assertIn('mangopay_concurrency_limit 4.0', generate_latest(metrics))
+
+    def test_batch_follows_the_limit(self):
+        lock = threading.Lock()
+        running, peak = [0], [0]
+
+        def call():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+
+            time.sleep(0.01)
+
+            with lock:
+                running[0] -= 1
+
+            raise APIError('Too many requests', code=429)
+
+        concurrency = AdaptiveConcurrency(initial=2, max_limit=8)
+        batch = Batch(None, max_workers=8, concurrency=concurrency)
+
+        for i in range(10):
+            batch.add(call)
+
+        results = batch.run()
+
+        self.assertEqual(len(results), 10)
+        self.assertLessEqual(peak[0], 2)
+        self.assertEqual(concurrency.limit, 1)
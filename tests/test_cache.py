@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import responses
+
+from mangopay.api import APIRequest
+from mangopay.cache import BloomFilter, MemoryBackend, ResponseCache, SharedMemoryBackend, SQLiteBackend
+from mangopay.exceptions import APIError
+
+from .helpers import get_handler
+from .resources import LegalUser, NaturalUser, User, Wallet
+
+
+class ResponseCacheTest(unittest.TestCase):
+    wallet_url = 'https://api.sandbox.mangopay.com/v2/chouette/wallets/1169421'
+    wallet = {
+        "Owners": ["1169419"],
+        "Description": "Wallet of Victor Hugo",
+        "Balance": {"Currency": "EUR", "Amount": 0},
+        "Currency": "EUR",
+        "Id": "1169421",
+        "Tag": "My custom tag",
+        "CreationDate": 1383323329
+    }
+
+    def get_handler(self, **kwargs):
+        return get_handler(cache=ResponseCache(**kwargs))
+
+    def mock_wallet(self):
+        responses.add(responses.GET, self.wallet_url, body=json.dumps(self.wallet), status=200, content_type='application/json')
+
+    @responses.activate
+    def test_get_is_read_through(self):
+        self.mock_wallet()
+
+        handler = self.get_handler()
+
+        first = Wallet.get(1169421, handler=handler)
+        second = Wallet.get(1169421, handler=handler)
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertIsNot(first.owners_ids, second.owners_ids)
+        self.assertFalse(second.is_dirty())
+        self.assertEqual(second.balance, first.balance)
+        self.assertEqual(handler.cache.stats(), {'hits': 1, 'misses': 1, 'stale_hits': 0,
+                                                 'negative_hits': 0, 'evictions': 0, 'size': 1})
+
+    @responses.activate
+    def test_entries_expire(self):
+        self.mock_wallet()
+
+        handler = self.get_handler(ttl=0.01)
+
+        Wallet.get(1169421, handler=handler)
+        time.sleep(0.02)
+        Wallet.get(1169421, handler=handler)
+
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_update_invalidates(self):
+        self.mock_wallet()
+        responses.add(responses.PUT, self.wallet_url, body=json.dumps(dict(self.wallet, Tag='updated')),
+                      status=200, content_type='application/json')
+
+        handler = self.get_handler()
+
+        wallet = Wallet.get(1169421, handler=handler)
+        wallet.tag = 'updated'
+        wallet.save()
+
+        Wallet.get(1169421, handler=handler)
+
+        self.assertEqual([call.request.method for call in responses.calls], ['GET', 'PUT', 'GET'])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = ResponseCache(maxsize=2)
+
+        cache.set(Wallet, 1, {'Id': '1'})
+        cache.set(Wallet, 2, {'Id': '2'})
+        cache.get(Wallet, 1)
+        cache.set(Wallet, 3, {'Id': '3'})
+
+        self.assertIsNone(cache.get(Wallet, 2))
+        self.assertEqual(cache.get(Wallet, 1), {'Id': '1'})
+        self.assertEqual(cache.evictions, 1)
+
+    def test_ttls_follow_the_model_hierarchy(self):
+        cache = ResponseCache(ttl=60, ttls={User: 5, LegalUser: 0})
+
+        self.assertEqual(cache.get_ttl(NaturalUser), 5)
+        self.assertEqual(cache.get_ttl(Wallet), 60)
+
+        cache.set(LegalUser, 1, {'Id': '1'})
+
+        self.assertEqual(len(cache), 0)
+
+    def test_resources_share_their_entries(self):
+        cache = ResponseCache()
+
+        cache.set(User, 1, {'Id': '1'})
+
+        self.assertEqual(cache.get(NaturalUser, '1'), {'Id': '1'})
+
+    def test_entries_are_keyed_by_client(self):
+        backend = MemoryBackend()
+
+        first = APIRequest(client_id='first', passphrase='secret', cache=ResponseCache(backend=backend))
+        second = APIRequest(client_id='second', passphrase='secret', cache=ResponseCache(backend=backend))
+
+        first.cache.set(Wallet, 1, {'Id': '1'})
+
+        self.assertIsNone(second.cache.get(Wallet, 1))
+        self.assertEqual(first.cache.get_key(Wallet, 1), 'first@%s:wallets:1' % first.api_url)
+
+    def test_clients_share_a_cache_given_a_namespace(self):
+        cache = ResponseCache()
+
+        APIRequest(client_id='first', passphrase='secret', cache=cache)
+
+        with self.assertRaises(ValueError):
+            APIRequest(client_id='second', passphrase='secret', cache=cache)
+
+        cache = ResponseCache(namespace='shared')
+
+        APIRequest(client_id='first', passphrase='secret', cache=cache)
+        APIRequest(client_id='second', passphrase='secret', cache=cache)
+
+        self.assertEqual(cache.get_key(Wallet, 1), 'shared:wallets:1')
+
+
+class StaleWhileRevalidateTest(unittest.TestCase):
+    url = ResponseCacheTest.wallet_url
+    wallet = ResponseCacheTest.wallet
+
+    @responses.activate
+    def test_stale_entries_are_served_and_refreshed(self):
+        responses.add(responses.GET, self.url, body=json.dumps(self.wallet), status=200,
+                      content_type='application/json')
+        responses.add(responses.GET, self.url, body=json.dumps(dict(self.wallet, Tag='refreshed')), status=200,
+                      content_type='application/json')
+
+        cache = ResponseCache(ttl=0.01, stale_ttls={Wallet: 60})
+        handler = get_handler(cache=cache)
+
+        Wallet.get(1169421, handler=handler)
+        time.sleep(0.02)
+
+        stale = Wallet.get(1169421, handler=handler)
+        cache._executor.shutdown(wait=True)
+
+        self.assertEqual(stale.tag, 'My custom tag')
+        self.assertEqual(cache.stale_hits, 1)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(cache.get(Wallet, 1169421)['Tag'], 'refreshed')
+
+    def test_entries_without_stale_period_expire(self):
+        cache = ResponseCache(ttl=0.01, stale_ttls={User: 60})
+
+        cache.set(Wallet, 1, {'Id': '1'})
+        time.sleep(0.02)
+
+        self.assertEqual(cache.lookup(Wallet, 1), (None, False))
+
+    def test_refreshes_are_deduplicated(self):
+        cache = ResponseCache(stale_ttl=60)
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def refresh():
+            calls.append(1)
+            started.set()
+            release.wait(1)
+
+        future = cache.revalidate(Wallet, 1, refresh)
+        started.wait(1)
+
+        self.assertIsNone(cache.revalidate(Wallet, 1, refresh))
+
+        release.set()
+        future.result()
+
+        cache.revalidate(Wallet, 1, refresh).result()
+
+        self.assertEqual(len(calls), 2)
+
+    def test_failed_refreshes_are_logged(self):
+        cache = ResponseCache(stale_ttl=60)
+        records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        handler = Handler(logging.WARNING)
+        logging.getLogger('mangopay').addHandler(handler)
+
+        def refresh():
+            raise APIError('boom')
+
+        try:
+            cache.revalidate(Wallet, 1, refresh).result()
+        finally:
+            logging.getLogger('mangopay').removeHandler(handler)
+
+        self.assertEqual([record.getMessage() for record in records],
+                         ['CACHE[wallets:1] refresh failed: boom'])
+        self.assertTrue(cache.claim_refresh(Wallet, 1))
+
+class NegativeCacheTest(unittest.TestCase):
+    url = 'https://api.sandbox.mangopay.com/v2/chouette/wallets/1169421'
+    not_found = {"Message": "The ressource does not exist", "Type": "ressource_not_found",
+                 "errors": {"RessourceNotFound": "Cannot found the ressource Wallet with the id=1169421 "}}
+
+    def get_handler(self, **kwargs):
+        return get_handler(cache=ResponseCache(**kwargs))
+
+    def mock_not_found(self):
+        responses.add(responses.GET, self.url, body=json.dumps(self.not_found), status=404, content_type='application/json')
+
+    @responses.activate
+    def test_missing_references_are_remembered(self):
+        self.mock_not_found()
+
+        handler = self.get_handler(negative_ttl=5)
+
+        for i in range(3):
+            self.assertRaises(Wallet.DoesNotExist, Wallet.get, 1169421, handler=handler)
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(handler.cache.negative_hits, 2)
+
+    @responses.activate
+    def test_disabled_by_default(self):
+        self.mock_not_found()
+
+        handler = self.get_handler()
+
+        self.assertRaises(Wallet.DoesNotExist, Wallet.get, 1169421, handler=handler)
+        self.assertRaises(Wallet.DoesNotExist, Wallet.get, 1169421, handler=handler)
+
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_known_ids_bypass_missing_entries(self):
+        self.mock_not_found()
+        responses.add(responses.GET, 'https://api.sandbox.mangopay.com/v2/chouette/wallets',
+                      body=json.dumps([ResponseCacheTest.wallet]), status=200, content_type='application/json')
+
+        handler = self.get_handler(negative_ttl=5, known_ids=BloomFilter(capacity=1000))
+
+        self.assertRaises(Wallet.DoesNotExist, Wallet.get, 1169421, handler=handler)
+
+        Wallet.all(handler=handler)
+
+        self.assertRaises(Wallet.DoesNotExist, Wallet.get, 1169421, handler=handler)
+        self.assertEqual(len(responses.calls), 3)
+
+    def test_insert_clears_missing_entries(self):
+        cache = ResponseCache(negative_ttl=5)
+
+        cache.set_missing(Wallet, 1)
+        cache.invalidate(Wallet, 1)
+
+        self.assertFalse(cache.is_missing(Wallet, 1))
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_membership(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+
+        for i in range(1000):
+            bloom.add('wallets:%d' % i)
+
+        self.assertTrue(all('wallets:%d' % i in bloom for i in range(1000)))
+
+        false_positives = sum(1 for i in range(1000, 11000) if 'wallets:%d' % i in bloom)
+
+        self.assertLess(false_positives, 300)
+
+
+class BackendTestMixin(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_set_and_get(self):
+        backend = self.get_backend()
+
+        backend.set('wallets:1', '{"Id": "1"}', 60)
+
+        self.assertEqual(backend.get('wallets:1'), '{"Id": "1"}')
+        self.assertIsNone(backend.get('wallets:2'))
+        self.assertEqual(len(backend), 1)
+
+    def test_expired_entries_are_ignored(self):
+        backend = self.get_backend()
+
+        backend.set('wallets:1', '{"Id": "1"}', 0.01)
+        time.sleep(0.02)
+
+        self.assertIsNone(backend.get('wallets:1'))
+
+    def test_delete_and_clear(self):
+        backend = self.get_backend()
+
+        backend.set('wallets:1', '{"Id": "1"}', 60)
+        backend.set('wallets:2', '{"Id": "2"}', 60)
+        backend.delete('wallets:1')
+
+        self.assertIsNone(backend.get('wallets:1'))
+        self.assertEqual(backend.get('wallets:2'), '{"Id": "2"}')
+
+        backend.clear()
+
+        self.assertEqual(len(backend), 0)
+
+    def test_response_cache(self):
+        backend = self.get_backend()
+        cache = ResponseCache(backend=backend)
+
+        self.assertIs(cache.backend, backend)
+
+        cache.set(Wallet, 1169421, {'Id': '1169421', 'Tag': u'\xe9t\xe9'})
+
+        self.assertEqual(cache.get(Wallet, 1169421), {'Id': '1169421', 'Tag': u'\xe9t\xe9'})
+
+
+class MemoryBackendTest(BackendTestMixin, unittest.TestCase):
+    def get_backend(self):
+        return MemoryBackend()
+
+
+class SQLiteBackendTest(BackendTestMixin, unittest.TestCase):
+    def get_backend(self, **kwargs):
+        return SQLiteBackend(os.path.join(self.directory, 'cache.db'), **kwargs)
+
+    def test_shared_between_instances(self):
+        self.get_backend().set('wallets:1', '{"Id": "1"}', 60)
+
+        self.assertEqual(self.get_backend().get('wallets:1'), '{"Id": "1"}')
+
+    def test_least_recently_used_entries_are_evicted(self):
+        backend = self.get_backend(maxsize=2, touch_interval=0)
+
+        backend.set('wallets:1', '1', 60)
+        backend.set('wallets:2', '2', 60)
+        backend.get('wallets:1')
+        backend.set('wallets:3', '3', 60)
+
+        self.assertIsNone(backend.get('wallets:2'))
+        self.assertEqual(backend.get('wallets:1'), '1')
+        self.assertEqual(backend.evictions, 1)
+
+
+    def test_hits_record_their_access_once_per_interval(self):
+        backend = self.get_backend(touch_interval=60)
+
+        backend.set('wallets:1', '1', 60)
+        accessed_at = backend.connection.execute('SELECT accessed_at FROM entries').fetchone()[0]
+
+        time.sleep(0.01)
+
+        self.assertEqual(backend.get('wallets:1'), '1')
+        self.assertEqual(backend.connection.execute('SELECT accessed_at FROM entries').fetchone()[0], accessed_at)
+
+
+class SharedMemoryBackendTest(BackendTestMixin, unittest.TestCase):
+    def get_backend(self, **kwargs):
+        return SharedMemoryBackend(os.path.join(self.directory, 'cache'), **kwargs)
+
+    def test_shared_between_instances(self):
+        self.get_backend().set('wallets:1', '{"Id": "1"}', 60)
+
+        self.assertEqual(self.get_backend().get('wallets:1'), '{"Id": "1"}')
+
+    def test_colliding_keys_replace_each_other(self):
+        backend = self.get_backend(slots=1)
+
+        backend.set('wallets:1', '1', 60)
+        backend.set('wallets:2', '2', 60)
+
+        self.assertIsNone(backend.get('wallets:1'))
+        self.assertEqual(backend.get('wallets:2'), '2')
+        self.assertEqual(backend.evictions, 1)
+
+    def test_large_values_are_skipped(self):
+        backend = self.get_backend(slot_size=64)
+
+        backend.set('wallets:1', 'x' * 64, 60)
+
+        self.assertIsNone(backend.get('wallets:1'))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+
+import requests
+import responses
+
+from mangopay.circuit import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+from mangopay.exceptions import APIError, CircuitOpenError
+from mangopay.signals import circuit_state_changed
+
+from .helpers import get_handler
+from .resources import Wallet
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.changes = []
+        circuit_state_changed.connect(self.on_change)
+
+    def tearDown(self):
+        circuit_state_changed.disconnect(self.on_change)
+
+    def on_change(self, sender, family, previous, state):
+        self.changes.append((family, previous, state))
+
+    def call(self, breaker, failed, family='reads'):
+        breaker.acquire(family)
+        breaker.release(family, failed)
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=3)
+
+        for failed in (True, True, False, True, True):
+            self.call(breaker, failed)
+
+        self.assertEqual(breaker.get_state('reads'), CLOSED)
+
+        self.call(breaker, True)
+
+        self.assertEqual(breaker.get_state('reads'), OPEN)
+        self.assertEqual(self.changes, [('reads', CLOSED, OPEN)])
+
+        with self.assertRaises(CircuitOpenError) as cm:
+            breaker.acquire('reads')
+
+        self.assertEqual(cm.exception.family, 'reads')
+        self.assertGreater(cm.exception.retry_after, 0)
+
+    def test_opens_on_error_ratio(self):
+        breaker = CircuitBreaker(failure_threshold=100, error_ratio=0.5, min_calls=10)
+
+        for i in range(9):
+            self.call(breaker, i % 2 == 0)
+
+        self.assertEqual(breaker.get_state('reads'), CLOSED)
+
+        self.call(breaker, True)
+
+        self.assertEqual(breaker.get_state('reads'), OPEN)
+
+    def test_families_are_independent(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+
+        self.call(breaker, True, family='payins')
+
+        self.assertEqual(breaker.get_state('payins'), OPEN)
+        self.call(breaker, False, family='users')
+        self.assertEqual(breaker.get_family('POST', '/payins/card/direct'), 'payins')
+        self.assertEqual(breaker.get_family('PUT', '/users/natural/1169419'), 'users')
+        self.assertEqual(breaker.get_family('GET', '/payins/1'), 'reads')
+
+    def test_half_open_trial_calls(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+
+        self.call(breaker, True)
+        time.sleep(0.02)
+
+        breaker.acquire('reads')
+
+        self.assertEqual(breaker.get_state('reads'), HALF_OPEN)
+        self.assertRaises(CircuitOpenError, breaker.acquire, 'reads')
+
+        breaker.release('reads', True)
+
+        self.assertEqual(breaker.get_state('reads'), OPEN)
+
+        time.sleep(0.02)
+        self.call(breaker, False)
+
+        self.assertEqual(breaker.get_state('reads'), CLOSED)
+        self.assertEqual([state for family, previous, state in self.changes],
+                         [OPEN, HALF_OPEN, OPEN, HALF_OPEN, CLOSED])
+
+    def test_uncounted_calls_free_their_slot(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+
+        self.call(breaker, True)
+        time.sleep(0.02)
+        self.call(breaker, None)
+
+        self.assertEqual(breaker.get_state('reads'), HALF_OPEN)
+
+        self.call(breaker, False)
+
+        self.assertEqual(breaker.get_state('reads'), CLOSED)
+
+
+class CircuitBreakerHandlerTest(unittest.TestCase):
+    url = 'https://api.sandbox.mangopay.com/v2/chouette/wallets/1169421'
+
+    def get_handler(self, **kwargs):
+        return get_handler(circuit_breaker=CircuitBreaker(**kwargs))
+
+    @responses.activate
+    def test_open_circuit_fails_fast(self):
+        responses.add(responses.GET, self.url, body='{}', status=503)
+
+        handler = self.get_handler(failure_threshold=2)
+
+        for i in range(2):
+            self.assertRaises(APIError, Wallet.get, 1169421, handler=handler)
+
+        self.assertRaises(CircuitOpenError, Wallet.get, 1169421, handler=handler)
+        self.assertEqual(len(responses.calls), 2)
+
+        # writes are another family
+        responses.add(responses.PUT, self.url, body='{"Id": "1169421"}', status=200)
+        Wallet.update(1169421, tag='updated').execute(handler=handler)
+
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_connection_errors_and_client_errors(self):
+        responses.add(responses.GET, self.url, body=requests.exceptions.ConnectionError('refused'))
+        responses.add(responses.GET, self.url, body='{"errors": {}}', status=404)
+
+        handler = self.get_handler(failure_threshold=2)
+
+        self.assertRaises(APIError, Wallet.get, 1169421, handler=handler)
+        self.assertRaises(Wallet.DoesNotExist, Wallet.get, 1169421, handler=handler)
+
+        self.assertEqual(handler.circuit_breaker.circuits['reads'].failures, 0)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+import unittest
+
+import responses
+
+from mangopay.identity import IdentityMap
+
+from .helpers import get_handler
+from .resources import NaturalUser, Transaction, User, Wallet
+
+
+NATURAL_USER = {
+    "FirstName": "Victor",
+    "LastName": "Hugo",
+    "Email": "victor@hugo.com",
+    "PersonType": "NATURAL",
+    "Id": "1169419",
+    "Tag": "custom tag",
+    "CreationDate": 1383321421
+}
+
+WALLET = {
+    "Owners": ["1169419"],
+    "Description": "Wallet of Victor Hugo",
+    "Balance": {"Currency": "EUR", "Amount": 0},
+    "Currency": "EUR",
+    "Id": "1169421",
+    "Tag": "My custom tag",
+    "CreationDate": 1383323329
+}
+
+
+def transaction(id):
+    return {
+        "Id": str(id),
+        "AuthorId": "1169419",
+        "CreditedUserId": "1169419",
+        "CreditedWalletId": "1169421",
+        "DebitedFunds": {"Currency": "EUR", "Amount": 1000},
+        "CreditedFunds": {"Currency": "EUR", "Amount": 1000},
+        "Fees": {"Currency": "EUR", "Amount": 0},
+        "Status": "SUCCEEDED",
+        "Type": "PAYIN",
+        "Nature": "REGULAR",
+        "CreationDate": 1383323329
+    }
+
+
+class UnitOfWorkTest(unittest.TestCase):
+    base_url = 'https://api.sandbox.mangopay.com/v2/chouette'
+
+    def mock(self, path, body):
+        responses.add(responses.GET, self.base_url + path, body=json.dumps(body), status=200,
+                      content_type='application/json')
+
+    @responses.activate
+    def test_related_objects_are_shared(self):
+        self.mock('/users/1169419/transactions', [transaction(i) for i in range(1, 51)])
+        self.mock('/users/1169419', NATURAL_USER)
+        self.mock('/wallets/1169421', WALLET)
+
+        with get_handler().unit_of_work() as session:
+            transactions = Transaction.all(handler=session, user_id=1169419)
+
+            authors = set(id(transaction.author) for transaction in transactions)
+            credited_users = set(id(transaction.credited_user) for transaction in transactions)
+            wallets = set(id(transaction.credited_wallet) for transaction in transactions)
+
+            self.assertEqual(len(authors), 1)
+            self.assertEqual(authors, credited_users)
+            self.assertEqual(len(wallets), 1)
+            self.assertIsInstance(transactions[0].author, NaturalUser)
+
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(len(session.identity_map), 0)
+
+    @responses.activate
+    def test_get_returns_the_same_instance(self):
+        self.mock('/users/1169419', NATURAL_USER)
+
+        session = get_handler().unit_of_work()
+
+        self.assertIs(User.get(1169419, handler=session), User.get(1169419, handler=session))
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_concurrent_gets_send_one_request(self):
+        def callback(request):
+            time.sleep(0.05)
+            return 200, {'Content-Type': 'application/json'}, json.dumps(WALLET)
+
+        responses.add_callback(responses.GET, self.base_url + '/wallets/1169421', callback=callback)
+
+        session = get_handler().unit_of_work()
+        results = []
+
+        def get():
+            results.append(Wallet.get(1169421, handler=session))
+
+        threads = [threading.Thread(target=get) for i in range(8)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(len(set(id(wallet) for wallet in results)), 1)
+
+
+class IdentityMapTest(unittest.TestCase):
+    def test_add_keeps_the_first_instance(self):
+        identity_map = IdentityMap()
+
+        first = identity_map.add(Wallet(id=1))
+        second = identity_map.add(Wallet(id=1))
+
+        self.assertIs(first, second)
+        self.assertIn(Wallet(id=1), identity_map)
+        self.assertIs(identity_map.get(Wallet, '1'), first)
+
+    def test_failed_loads_are_not_kept(self):
+        identity_map = IdentityMap()
+
+        def fetch():
+            raise Wallet.DoesNotExist()
+
+        self.assertRaises(Wallet.DoesNotExist, identity_map.load, Wallet, 1, fetch)
+        self.assertIs(identity_map.load(Wallet, 1, lambda: Wallet(id=1)), identity_map.get(Wallet, 1))
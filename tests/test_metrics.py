@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+import responses
+
+from mangopay.metrics import Histogram, MetricsRegistry, generate_latest
+from mangopay.retry import RetryPolicy
+
+from .helpers import get_handler
+from .resources import Transaction, Wallet
+from .test_identity import WALLET, transaction
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    base_url = 'https://api.sandbox.mangopay.com/v2/chouette'
+
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+        self.handler = get_handler(retry_policy=RetryPolicy(backoff_factor=0), metrics=self.metrics)
+
+    @responses.activate
+    def test_calls_are_keyed_by_url_template(self):
+        responses.add(responses.GET, self.base_url + '/wallets/1169421', body='{}', status=503)
+        responses.add(responses.GET, self.base_url + '/wallets/1169421', body=json.dumps(WALLET), status=200)
+        responses.add(responses.GET, self.base_url + '/users/1169419/transactions',
+                      body=json.dumps([transaction(1)]), status=200)
+
+        Wallet.get(1169421, handler=self.handler)
+        Transaction.all(handler=self.handler, user_id=1169419)
+
+        key = ('GET', '/wallets/%(id)s')
+
+        self.assertEqual(self.metrics.requests[key + ('503', )], 1)
+        self.assertEqual(self.metrics.requests[key + ('200', )], 1)
+        self.assertEqual(dict(self.metrics.errors), {key + ('503', ): 1})
+        self.assertEqual(self.metrics.retries[key], 1)
+        self.assertEqual(self.metrics.latencies[key].count, 2)
+        self.assertEqual(self.metrics.bytes_received[key], len(json.dumps(WALLET)) + 2)
+        self.assertEqual(self.metrics.requests[('GET', '/users/%(user_id)s/transactions', '200')], 1)
+
+    @responses.activate
+    def test_writes_count_the_bytes_sent(self):
+        responses.add(responses.PUT, self.base_url + '/wallets/1169421', body=json.dumps(WALLET), status=200)
+
+        Wallet.update(1169421, tag='updated').execute(handler=self.handler)
+
+        key = ('PUT', '/wallets/%(id)s')
+
+        self.assertEqual(self.metrics.bytes_sent[key], len(json.dumps({'Tag': 'updated'})))
+        self.assertEqual(self.metrics.requests[key + ('200', )], 1)
+
+    @responses.activate
+    def test_raw_calls_have_their_ids_masked(self):
+        responses.add(responses.GET, self.base_url + '/users/1169419/cards', body='[]', status=200)
+
+        self.handler.request('GET', '/users/1169419/cards', per_page=10)
+
+        self.assertEqual(list(self.metrics.requests), [('GET', '/users/%(id)s/cards', '200')])
+
+    def test_prometheus_exposition(self):
+        self.metrics.observe('GET', '/wallets/%(id)s', 200, 0.02, bytes_received=120)
+        self.metrics.observe('GET', '/wallets/%(id)s', None, 3)
+        self.metrics.observe_retry('GET', '/wallets/%(id)s')
+
+        text = generate_latest(self.metrics)
+        labels = 'method="GET",endpoint="/wallets/%(id)s"'
+
+        self.assertIn('# TYPE mangopay_requests_total counter', text)
+        self.assertIn('mangopay_requests_total{%s,status="200"} 1.0' % labels, text)
+        self.assertIn('mangopay_errors_total{%s,status="error"} 1.0' % labels, text)
+        self.assertIn('mangopay_response_bytes_total{%s} 120.0' % labels, text)
+        self.assertIn('mangopay_retries_total{%s} 1.0' % labels, text)
+        self.assertIn('# TYPE mangopay_request_duration_seconds histogram', text)
+        self.assertIn('mangopay_request_duration_seconds_bucket{%s,le="0.025"} 1.0' % labels, text)
+        self.assertIn('mangopay_request_duration_seconds_bucket{%s,le="+Inf"} 2.0' % labels, text)
+        self.assertIn('mangopay_request_duration_seconds_count{%s} 2.0' % labels, text)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram(buckets=(0.1, 1))
+
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.get_cumulative_counts(), [(0.1, 2), (1, 3), (None, 4)])
+        self.assertAlmostEqual(histogram.sum, 5.65)
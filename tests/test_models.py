@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+import responses
+
+from mangopay.fields import CharField
+from mangopay.utils import Money
+
+from .resources import CardRegistration, NaturalUser, Transaction, Transfer, Ubo, Wallet
+
+
+class DecoderTest(unittest.TestCase):
+    def test_decode(self):
+        pairs = Transaction._meta.decode({
+            "Id": "1174837",
+            "AuthorId": "1169419",
+            "DebitedFunds": {"Currency": "EUR", "Amount": 1000},
+            "Status": "SUCCEEDED",
+            "ExecutionDate": None,
+            "Unknown": "ignored",
+        })
+
+        self.assertEqual(pairs, {
+            'id': 1174837,
+            'author_id': 1169419,
+            'debited_funds': Money(1000, 'EUR'),
+            'status': 'SUCCEEDED',
+            'execution_date': None,
+        })
+
+    def test_decoder_is_compiled_per_class(self):
+        self.assertIn('FirstName', NaturalUser._meta.decoder)
+        self.assertNotIn('FirstName', Transaction._meta.decoder)
+
+    def test_overridden_conversions_are_kept(self):
+        class UpperCharField(CharField):
+            def python_value(self, value):
+                return value.upper()
+
+            def api_value(self, value):
+                return value.lower()
+
+        field = UpperCharField(api_name='Tag')
+
+        self.assertEqual(field.get_python_converter()('tag'), 'TAG')
+        self.assertEqual(field.get_api_converter()('TAG'), 'tag')
+
+    def test_empty_result(self):
+        self.assertEqual(NaturalUser._meta.decode(None), {})
+
+    def test_matches_field_transcription(self):
+        query = CardRegistration.select()
+        transcription = query.get_field_transcription()
+        result = dict((api_name, 1) for api_name in transcription)
+
+        self.assertEqual(query.parse_result(result),
+                         dict((name, CardRegistration._meta.get_field_by_name(name).python_value(result[api_name]))
+                              for api_name, name in transcription.items()))
+
+
+class EncoderTest(unittest.TestCase):
+    def test_encode(self):
+        payload = Transfer._meta.encode({
+            'author_id': NaturalUser(id=1169419),
+            'debited_funds': Money(1000, 'EUR'),
+            'tag': None,
+            'debited_wallet_id': None,
+            'credited_wallet_id': None,
+        })
+
+        self.assertEqual(payload, {
+            'AuthorId': 1169419,
+            'DebitedFunds': {'Currency': 'EUR', 'Amount': 1000},
+            'CreditedWalletId': None,
+        })
+
+    def test_unknown_field(self):
+        with self.assertRaises(AttributeError):
+            Transfer._meta.encode({'unknown': 1})
+
+    def test_save_payload(self):
+        transfer = Transfer(author=NaturalUser(id=1169419),
+                            credited_user=NaturalUser(id=1169420),
+                            debited_funds=Money(1000, 'EUR'),
+                            fees=Money(100, 'EUR'),
+                            credited_wallet=Wallet(id=1169421))
+
+        query, created = transfer.get_save_query()
+
+        self.assertTrue(created)
+        self.assertEqual(query.parse_insert(), {
+            'AuthorId': 1169419,
+            'CreditedUserId': 1169420,
+            'DebitedFunds': {'Currency': 'EUR', 'Amount': 1000},
+            'Fees': {'Currency': 'EUR', 'Amount': 100},
+            'CreditedWalletId': 1169421,
+            'CreditedFunds': None,
+        })
+
+
+class DirtyFieldsTest(unittest.TestCase):
+    url = 'https://api.sandbox.mangopay.com/v2/chouette/wallets/1169421'
+    wallet = {
+        "Owners": ["1169419"],
+        "Description": "Wallet of Victor Hugo",
+        "Balance": {"Currency": "EUR", "Amount": 0},
+        "Currency": "EUR",
+        "Id": "1169421",
+        "Tag": "My custom tag",
+        "CreationDate": 1383323329
+    }
+
+    def mock_wallet(self, **changes):
+        responses.add(responses.GET, self.url, body=json.dumps(self.wallet), status=200,
+                      content_type='application/json')
+        responses.add(responses.PUT, self.url, body=json.dumps(dict(self.wallet, **changes)), status=200,
+                      content_type='application/json')
+
+    @responses.activate
+    def test_hydrated_instance_is_clean(self):
+        self.mock_wallet()
+
+        wallet = Wallet.get(1169421)
+
+        self.assertFalse(wallet.is_dirty())
+
+    @responses.activate
+    def test_save_sends_modified_fields(self):
+        self.mock_wallet(Tag='updated')
+
+        wallet = Wallet.get(1169421)
+        wallet.tag = 'updated'
+
+        self.assertEqual(wallet.get_dirty_fields(), set(['tag']))
+
+        wallet.save()
+
+        self.assertEqual(json.loads(responses.calls[-1].request.body), {'Tag': 'updated'})
+        self.assertFalse(wallet.is_dirty())
+
+    @responses.activate
+    def test_save_without_changes_skips_the_request(self):
+        self.mock_wallet()
+
+        wallet = Wallet.get(1169421)
+
+        self.assertEqual(wallet.save(), {})
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_in_place_changes_are_tracked(self):
+        self.mock_wallet(Owners=['1169419', '1169420'])
+
+        wallet = Wallet.get(1169421)
+
+        # copies are only taken for the fields read after hydration
+        self.assertEqual(wallet._snapshots, {})
+
+        wallet.owners_ids.append('1169420')
+        wallet.balance.amount = 100
+
+        self.assertEqual(wallet.get_dirty_fields(), set(['owners_ids', 'balance']))
+
+        wallet.save()
+
+        self.assertEqual(json.loads(responses.calls[-1].request.body), {
+            'Owners': ['1169419', '1169420'],
+            'Balance': {'Currency': 'EUR', 'Amount': 100},
+        })
+        self.assertFalse(wallet.is_dirty())
+
+    def test_foreign_keys_are_tracked(self):
+        transfer = Transfer(id=1)
+        transfer.mark_clean()
+
+        transfer.credited_wallet = Wallet(id=1169421)
+
+        self.assertEqual(transfer.get_dirty_fields(), set(['credited_wallet_id']))
+        self.assertEqual(transfer.credited_wallet_id, 1169421)
+
+    def test_url_params_are_kept(self):
+        ubo = Ubo(id=1, user_id=2, ubo_declaration_id=3, first_name='Victor', last_name='Hugo')
+        ubo.mark_clean()
+        ubo.first_name = 'Updated'
+
+        query, created = ubo.get_save_query()
+
+        self.assertEqual(query.get_url(), '/users/2/kyc/ubodeclarations/3/ubos/1')
+        self.assertEqual(query.parse_update(), {'FirstName': 'Updated', 'User': 2, 'Ubo Declaration': 3})
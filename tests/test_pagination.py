@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+
+import responses
+
+from six.moves.urllib.parse import parse_qs, urlparse
+
+from .resources import NaturalUser, Transaction, User
+from .test_base import BaseTest
+
+
+def transaction(id):
+    return {"Id": str(id), "Type": "TRANSFER", "Status": "SUCCEEDED", "AuthorId": "1169419"}
+
+
+class PaginationTest(BaseTest):
+    def mock_transaction_pages(self, pages, per_page, headers=True):
+        items = sum(len(page) for page in pages)
+
+        for number, page in enumerate(pages, 1):
+            responses.add(responses.GET,
+                          'https://api.sandbox.mangopay.com/v2/chouette/users/1169419/transactions'
+                          '?page=%d&per_page=%d&user_id=1169419' % (number, per_page),
+                          body=json.dumps(page), status=200, content_type='application/json',
+                          headers={'X-Number-Of-Pages': str(len(pages)),
+                                   'X-Number-Of-Items': str(items)} if headers else {},
+                          match_querystring=True)
+
+    @responses.activate
+    def test_iterator_walks_every_page(self):
+        self.mock_transaction_pages([[transaction(1), transaction(2)],
+                                     [transaction(3), transaction(4)],
+                                     [transaction(5)]], per_page=2)
+
+        transactions = Transaction.iterator(user_id=1169419, per_page=2)
+
+        self.assertIsNone(transactions.number_of_items)
+        self.assertEqual([t.id for t in transactions], [1, 2, 3, 4, 5])
+        self.assertEqual(transactions.number_of_pages, 3)
+        self.assertEqual(transactions.number_of_items, 5)
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_iterator_is_lazy(self):
+        self.mock_transaction_pages([[transaction(1), transaction(2)],
+                                     [transaction(3)]], per_page=2)
+
+        transactions = iter(Transaction.iterator(user_id=1169419, per_page=2))
+
+        self.assertEqual(next(transactions).id, 1)
+        self.assertEqual(next(transactions).id, 2)
+        self.assertEqual(len(responses.calls), 1)
+
+        self.assertEqual(next(transactions).id, 3)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_iterator_without_pagination_headers(self):
+        self.mock_transaction_pages([[transaction(1), transaction(2)],
+                                     [transaction(3)]], per_page=2, headers=False)
+
+        self.assertEqual([t.id for t in Transaction.iterator(user_id=1169419, per_page=2)], [1, 2, 3])
+
+    @responses.activate
+    def test_iterator_casts_results(self):
+        responses.add(responses.GET,
+                      'https://api.sandbox.mangopay.com/v2/chouette/users?page=1&per_page=100',
+                      body=json.dumps([{"Id": "1169419", "PersonType": "NATURAL", "Email": "victor@hugo.com"}]),
+                      status=200, content_type='application/json', match_querystring=True)
+
+        users = list(User.iterator())
+
+        self.assertEqual(len(users), 1)
+        self.assertIsInstance(users[0], NaturalUser)
+
+    @responses.activate
+    def test_related_manager_iterator(self):
+        self.mock_natural_user()
+        responses.add(responses.GET,
+                      'https://api.sandbox.mangopay.com/v2/chouette/users/1169419/transactions'
+                      '?page=1&per_page=10',
+                      body=json.dumps([transaction(1)]), status=200, content_type='application/json',
+                      headers={'X-Number-Of-Pages': '1', 'X-Number-Of-Items': '1'},
+                      match_querystring=True)
+
+        transactions = list(self.natural_user.transactions.iterator(per_page=10))
+
+        self.assertEqual([t.id for t in transactions], [1])
+        self.assertIsInstance(transactions[0], Transaction)
+
+    @responses.activate
+    def test_prefetch_keeps_order(self):
+        pages = [[transaction(i * 2 + 1), transaction(i * 2 + 2)] for i in range(5)]
+        self.mock_transaction_pages(pages, per_page=2)
+
+        transactions = Transaction.iterator(user_id=1169419, per_page=2, prefetch=3)
+
+        self.assertEqual([t.id for t in transactions], list(range(1, 11)))
+        self.assertEqual(len(responses.calls), 5)
+
+    @responses.activate
+    def test_prefetch_fetches_pages_concurrently(self):
+        started = dict((page, threading.Event()) for page in (2, 3))
+        overlapped = []
+
+        def callback(request):
+            page = int(parse_qs(urlparse(request.url).query)['page'][0])
+
+            if page in started:
+                started[page].set()
+                other = started[5 - page]
+                overlapped.append(other.wait(timeout=2))
+
+            headers = {'X-Number-Of-Pages': '3', 'X-Number-Of-Items': '3'}
+            return 200, headers, json.dumps([transaction(page)])
+
+        responses.add_callback(responses.GET,
+                               'https://api.sandbox.mangopay.com/v2/chouette/users/1169419/transactions',
+                               callback=callback, content_type='application/json')
+
+        transactions = Transaction.iterator(user_id=1169419, per_page=1, prefetch=2)
+
+        self.assertEqual([t.id for t in transactions], [1, 2, 3])
+        self.assertEqual(overlapped, [True, True])
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import responses
+
+from mangopay.ratelimit import RateLimiter, SharedTokenBucket, TokenBucket
+
+from .helpers import get_handler
+from .resources import Wallet
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_wait(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places=2)
+
+    def test_unlimited(self):
+        bucket = TokenBucket(rate=None, capacity=1)
+
+        self.assertEqual([bucket.reserve() for i in range(5)], [0] * 5)
+
+    def test_pause(self):
+        bucket = TokenBucket(rate=None)
+        bucket.pause(time.time() + 5)
+
+        self.assertAlmostEqual(bucket.reserve(), 5, places=1)
+
+
+class SharedTokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'bucket')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_budget_is_shared(self):
+        first = SharedTokenBucket(self.path, rate=1, capacity=2)
+        second = SharedTokenBucket(self.path, rate=1, capacity=50)
+
+        self.assertEqual(first.reserve(), 0)
+        self.assertEqual(second.reserve(), 0)
+        self.assertGreater(first.reserve(), 0.9)
+
+        second.set_rate(5)
+        self.assertEqual(first.rate, 5)
+
+    def test_survives_fork(self):
+        bucket = SharedTokenBucket(self.path, rate=0.001, capacity=10)
+        bucket.reserve()
+
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                for i in range(4):
+                    bucket.reserve()
+            finally:
+                os._exit(0)
+
+        os.waitpid(pid, 0)
+
+        self.assertAlmostEqual(bucket.tokens, 5, places=1)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(bucket=SharedTokenBucket(self.path), safety_factor=1)
+        now = time.time()
+
+        limiter.update({
+            'X-RateLimit-Remaining': '900',
+            'X-RateLimit-Reset': '%d' % (now + 900),
+        })
+
+        self.assertAlmostEqual(SharedTokenBucket(self.path).rate, 1, places=1)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_rate_follows_slowest_window(self):
+        limiter = RateLimiter(safety_factor=1)
+        now = time.time()
+
+        limiter.update({
+            'X-RateLimit-Remaining': '900, 1000',
+            'X-RateLimit-Reset': '%d, %d' % (now + 900, now + 3600),
+        })
+
+        self.assertAlmostEqual(limiter.rate, 1000 / 3600.0, places=3)
+
+    def test_exhausted_window_pauses(self):
+        limiter = RateLimiter()
+        now = time.time()
+
+        limiter.update({
+            'X-RateLimit-Remaining': '0, 1000',
+            'X-RateLimit-Reset': '%d, %d' % (now + 30, now + 3600),
+        })
+
+        self.assertGreater(limiter.reserve(), 25)
+
+    def test_missing_headers_are_ignored(self):
+        limiter = RateLimiter(rate=5)
+        limiter.update({})
+
+        self.assertEqual(limiter.rate, 5)
+
+    @responses.activate
+    def test_handler_reads_response_headers(self):
+        now = time.time()
+        responses.add(responses.GET, 'https://api.sandbox.mangopay.com/v2/chouette/wallets/1169421',
+                      body='{"Id": "1169421"}', status=200,
+                      headers={'X-RateLimit-Remaining': '1800', 'X-RateLimit-Reset': '%d' % (now + 900)})
+
+        limiter = RateLimiter(safety_factor=1)
+        handler = get_handler(rate_limiter=limiter)
+
+        Wallet.get(1169421, handler=handler)
+
+        self.assertAlmostEqual(limiter.rate, 2, places=1)
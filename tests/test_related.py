@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+import responses
+
+from .helpers import get_handler
+from .resources import NaturalUser, Transaction, Wallet
+from .test_identity import NATURAL_USER, WALLET, transaction
+
+
+class SelectRelatedTest(unittest.TestCase):
+    base_url = 'https://api.sandbox.mangopay.com/v2/chouette'
+
+    def setUp(self):
+        self.handler = get_handler()
+
+    def mock(self, path, body, status=200):
+        responses.add(responses.GET, self.base_url + path, body=json.dumps(body), status=status,
+                      content_type='application/json')
+
+    @responses.activate
+    def test_foreign_keys_are_fetched_once(self):
+        self.mock('/users/1169419/transactions', [transaction(i) for i in range(1, 51)])
+        self.mock('/users/1169419', NATURAL_USER)
+        self.mock('/wallets/1169421', WALLET)
+
+        transactions = Transaction.select().select_related('author', 'credited_wallet').all(handler=self.handler,
+                                                                                            user_id=1169419)
+
+        self.assertEqual(len(responses.calls), 3)
+
+        for transaction_ in transactions:
+            self.assertIsInstance(transaction_.author, NaturalUser)
+            self.assertEqual(transaction_.credited_wallet.get_pk(), 1169421)
+
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_missing_objects_are_left_lazy(self):
+        self.mock('/users/1169419/transactions', [transaction(1)])
+        self.mock('/wallets/1169421', {"errors": {"RessourceNotFound": "not found"}}, status=404)
+
+        transactions = Transaction.select().select_related('credited_wallet').all(handler=self.handler,
+                                                                                  user_id=1169419)
+
+        self.assertFalse(hasattr(transactions[0], '_cache_credited_wallet_id'))
+
+    @responses.activate
+    def test_many_to_many_fields_are_prefetched(self):
+        self.mock('/wallets', [dict(WALLET, Id=str(i), Owners=['1169419', '1169420']) for i in range(1, 11)])
+        self.mock('/users/1169419', NATURAL_USER)
+        self.mock('/users/1169420', dict(NATURAL_USER, Id='1169420'))
+
+        wallets = Wallet.select().prefetch_related('owners').all(handler=self.handler)
+
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual([owner.get_pk() for owner in wallets[-1].owners], [1169419, 1169420])
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_partially_missing_many_to_many_fields_are_left_lazy(self):
+        self.mock('/wallets', [dict(WALLET, Owners=['1169419', '1169420'])])
+        self.mock('/users/1169419', NATURAL_USER)
+        self.mock('/users/1169420', {"errors": {"RessourceNotFound": "not found"}}, status=404)
+
+        wallets = Wallet.select().prefetch_related('owners').all(handler=self.handler)
+
+        self.assertFalse(hasattr(wallets[0], '_cache_owners_ids'))
+
+    @responses.activate
+    def test_iterator_fetches_each_page(self):
+        self.mock('/users/1169419/transactions', [transaction(i) for i in range(1, 4)])
+        self.mock('/users/1169419', NATURAL_USER)
+
+        iterator = Transaction.select().select_related('author').iterator(handler=self.handler, per_page=10,
+                                                                          user_id=1169419)
+
+        authors = [transaction_.author for transaction_ in iterator]
+
+        self.assertEqual(len(authors), 3)
+        self.assertEqual(len(set(id(author) for author in authors)), 1)
+        self.assertEqual(len(responses.calls), 2)
+
+    def test_field_kinds_are_checked(self):
+        self.assertRaises(AttributeError, Transaction.select().select_related, 'unknown')
+        self.assertRaises(ValueError, Wallet.select().select_related, 'owners')
+        self.assertRaises(ValueError, Transaction.select().prefetch_related, 'author')
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+import responses
+
+from mangopay.exceptions import APIError
+from mangopay.hedge import HedgePolicy
+from mangopay.signals import request_started
+from mangopay.tracing import Tracer, get_current_span
+
+from .helpers import get_handler
+from .resources import NaturalUser, Transaction, Wallet
+from .test_identity import NATURAL_USER, WALLET, transaction
+
+
+class TracingTest(unittest.TestCase):
+    base_url = 'https://api.sandbox.mangopay.com/v2/chouette'
+
+    def setUp(self):
+        self.spans = []
+        self.tracer = Tracer(exporter=self.spans.append)
+        self.handler = get_handler(tracer=self.tracer)
+
+    def mock(self, method, path, body, status=200):
+        responses.add(method, self.base_url + path, body=json.dumps(body), status=status, content_type='application/json')
+
+    def get_span(self, name):
+        return [span for span in self.spans if span.name == name][0]
+
+    @responses.activate
+    def test_save_spans_contain_their_calls(self):
+        self.mock(responses.POST, '/wallets', WALLET)
+
+        with self.tracer.start_span('create wallet') as step:
+            Wallet.create(handler=self.handler, owners=[NaturalUser(id=1169419)],
+                          description='Wallet of Victor Hugo', currency='EUR')
+
+        save, request = self.get_span('mangopay.save'), self.get_span('mangopay.request')
+
+        self.assertEqual([span.name for span in self.spans], ['mangopay.request', 'mangopay.save', 'create wallet'])
+        self.assertIs(request.parent, save)
+        self.assertIs(save.parent, step)
+        self.assertEqual(len(set(span.trace_id for span in self.spans)), 1)
+        self.assertIsNone(get_current_span())
+
+        self.assertEqual(save.attributes['mangopay.model'], 'Wallet')
+        self.assertEqual(save.attributes['mangopay.query'], 'INSERT')
+        self.assertEqual(request.attributes['http.method'], 'POST')
+        self.assertEqual(request.attributes['http.route'], '/wallets')
+        self.assertEqual(request.attributes['http.status_code'], 200)
+        self.assertEqual(request.attributes['http.response_content_length'], len(json.dumps(WALLET)))
+        self.assertGreater(request.attributes['http.request_content_length'], 0)
+        self.assertGreaterEqual(request.duration, 0)
+
+    @responses.activate
+    def test_hedged_calls_run_within_the_request_span(self):
+        self.mock(responses.GET, '/wallets/1169421', WALLET)
+
+        self.handler.hedge_policy = HedgePolicy(min_samples=1, budget=1)
+        self.handler.hedge_policy.record(1)
+
+        parents = []
+
+        def on_started(sender, **kwargs):
+            parents.append(get_current_span())
+
+        request_started.connect(on_started)
+
+        try:
+            Wallet.get(1169421, handler=self.handler)
+        finally:
+            request_started.disconnect(on_started)
+
+        self.assertEqual(parents, [self.get_span('mangopay.request')])
+
+    @responses.activate
+    def test_related_objects_are_fetched_within_the_query_span(self):
+        self.mock(responses.GET, '/users/1169419/transactions', [transaction(i) for i in range(1, 4)])
+        self.mock(responses.GET, '/users/1169419', NATURAL_USER)
+        self.mock(responses.GET, '/wallets/1169421', WALLET)
+
+        Transaction.select().select_related('author', 'credited_wallet').all(handler=self.handler,
+                                                                            user_id=1169419)
+
+        query = self.get_span('mangopay.all')
+        gets = [span for span in self.spans if span.name == 'mangopay.get']
+
+        self.assertEqual(query.attributes['http.route'], '/users/%(user_id)s/transactions')
+        self.assertEqual(len(gets), 2)
+        self.assertTrue(all(span.parent is query for span in gets))
+        self.assertEqual(sorted(span.attributes['http.route'] for span in gets),
+                         ['/users/%(id)s', '/wallets/%(id)s'])
+
+    @responses.activate
+    def test_batches_keep_the_current_span(self):
+        self.mock(responses.GET, '/wallets/1169421', WALLET)
+
+        with self.tracer.start_span('batch') as step:
+            batch = self.handler.batch()
+            batch.get(Wallet, 1169421)
+            batch.run()
+
+        self.assertIs(self.get_span('mangopay.get').parent, step)
+
+    @responses.activate
+    def test_errors_are_recorded(self):
+        self.mock(responses.GET, '/wallets/1169421', {'Message': 'boom'}, status=500)
+
+        self.assertRaises(APIError, Wallet.get, 1169421, handler=self.handler)
+
+        request = self.get_span('mangopay.request')
+
+        self.assertIsInstance(request.error, APIError)
+        self.assertTrue(request.attributes['error'])
+        self.assertEqual(request.attributes['http.status_code'], 500)
+        self.assertIsInstance(self.get_span('mangopay.get').error, APIError)
+
+    @responses.activate
+    def test_handlers_without_tracer(self):
+        self.mock(responses.GET, '/wallets/1169421', WALLET)
+
+        self.handler.tracer = None
+
+        with self.tracer.start_span('step') as step:
+            Wallet.get(1169421, handler=self.handler)
+
+            self.assertIs(get_current_span(), step)
+
+        self.assertEqual(self.spans, [step])